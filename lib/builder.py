@@ -3,9 +3,9 @@
 # Build redo targets
 # ======================================================================
 
-import sys, os, errno, stat
-import vars, jobs, state, targets_seen, deps
-from helpers import remove, rename, close_on_exec, join
+import sys, os, errno, stat, time
+import vars, jobs, state, targets_seen, deps, dofiles
+from helpers import remove, rename, close_on_exec, join, file_digest
 from log import log, log_, debug, debug2, err, warn
 
 # ---------------------------------------------------------------------- 
@@ -26,6 +26,8 @@ def main(targets, shouldbuildfunc):
     if vars.SHUFFLE:
         import random
         random.shuffle(targets)
+    if vars.CRITICAL_PATH or vars.FAILED_FIRST:
+        targets = _schedule(targets)
 
     locked = []
 
@@ -37,12 +39,13 @@ def main(targets, shouldbuildfunc):
     # about any lock contention.  If someone else has it locked, we move on.
     seen = {}
     lock = None
+    state.File.bulk(targets)  # look them all up at once
     for t in targets:
         if t in seen:
             continue
         seen[t] = 1
         if not jobs.has_token():
-            state.commit()
+            state.commit(lazy=True)
         jobs.get_token(t)
         if retcode[0] and not vars.KEEP_GOING:
             break
@@ -61,6 +64,9 @@ def main(targets, shouldbuildfunc):
                 log('%s (locked...)\n' % _nice(t))
             locked.append((f.id,t))
         else:
+            # f was read before we had the lock, which we needed its id
+            # for; whoever held the lock may have built t since
+            f.refresh()
             BuildJob(t, f, lock, shouldbuildfunc, done).start()
 
     del lock
@@ -73,7 +79,7 @@ def main(targets, shouldbuildfunc):
     # of redo-ifchange; then we have to redo it even if someone else already
     # did.  But that should be rare.
     while locked or jobs.running():
-        state.commit()
+        state.commit(lazy=True)
         jobs.wait_all()
         # at this point, we don't have any children holding any tokens, so
         # it's okay to block below.
@@ -178,14 +184,19 @@ class BuildJob:
             # FIXME: always refuse to redo any file that was modified outside
             # of redo?  That would make it easy for someone to override a
             # file temporarily, and could be undone by deleting the file.
+            # Its depsets stay empty, so checking it reads no sets.
             debug2("-- static (%r)\n" % t)
             sf.set_static()
             sf.save()
             return self._after2(0)
         sf.zap_deps1()
-        (dodir, dofile, basedir, basename, ext) = _find_do_file(sf)
+        (dodir, dofile, basedir, basename, ext) = dofiles.find(sf)
         if not dofile:
             if os.path.exists(t):
+                # a target whose .do file is gone: keep only the dependences
+                # on where a .do file could appear, as sets, which unlike a
+                # source that was never built it then has to check
+                sf.zap_deps2()
                 sf.set_static()
                 sf.save()
                 return self._after2(0)
@@ -224,6 +235,7 @@ class BuildJob:
         dof.set_static()
         dof.save()
         state.commit()
+        self.start_time = time.time()
         jobs.start_job(t, self._do_subproc, self._after)
 
     def _start_unlocked(self, dirty):
@@ -310,15 +322,23 @@ class BuildJob:
                         _remove(t)
             except:
                 rv=208
+        self.sf.forget_stamp()
+        dofiles.forget(os.path.join(vars.BASE, self.sf.name))
         if rv == 0:
             sf = self.sf
             sf.refresh()
             sf.is_generated = True
             sf.is_override = False
+            sf.duration_ms = int((time.time() - self.start_time) * 1000)
             if sf.is_checked() or sf.is_changed():
                 # it got checked during the run; someone ran redo-stamp.
                 # update_stamp would call set_changed(); we don't want that
                 sf.stamp = sf.read_stamp()
+            elif vars.EARLY_CUTOFF or sf.is_cutoff():
+                # targets that depend on sf needn't rebuild if its
+                # output is identical to last time
+                sf.stamp = sf.read_stamp()
+                sf.set_csum(_output_csum(t))
             else:
                 sf.csum = None
                 sf.update_stamp()
@@ -370,53 +390,62 @@ def _rename(src, dest):
     return status
 
 
-def _default_do_files(filename):
-    l = filename.split('.')
-    for i in range(1,len(l)+1):
-        basename = join('.', l[:i])
-        ext = join('.', l[i:])
-        if ext: ext = '.' + ext
-        yield ("default%s.do" % ext), basename, ext
-    
-
-def _possible_do_files(t):
-    dirname,filename = os.path.split(t)
-    yield (os.path.join(vars.BASE, dirname), "%s.do" % filename,
-           '', filename, '')
-
-    # It's important to try every possibility in a directory before resorting
-    # to a parent directory.  Think about nested projects: I don't want
-    # ../../default.o.do to take precedence over ../default.do, because
-    # the former one might just be an artifact of someone embedding my project
-    # into theirs as a subdir.  When they do, my rules should still be used
-    # for building my project in *all* cases.
-    t = os.path.normpath(os.path.join(vars.BASE, t))
-    dirname,filename = os.path.split(t)
-    dirbits = dirname.split('/')
-    for i in range(len(dirbits), -1, -1):
-        basedir = join('/', dirbits[:i])
-        subdir = join('/', dirbits[i:])
-        for dofile,basename,ext in _default_do_files(filename):
-            yield (basedir, dofile,
-                   subdir, os.path.join(subdir, basename), ext)
-        
-
-def _find_do_file(f):
-    for dodir,dofile,basedir,basename,ext in _possible_do_files(f.name):
-        dopath = os.path.join(dodir, dofile)
-        debug2('%s: %s:%s ?\n' % (f.name, dodir, dofile))
-        if os.path.exists(dopath):
-            f.add_dep('m', dopath)
-            return dodir,dofile,basedir,basename,ext
-        else:
-            f.add_dep('c', dopath)
-    return None,None,None,None,None
-
-
 def _nice(t):
     return state.relpath(t, vars.STARTDIR)
 
 
+def _schedule(targets):
+    '''
+    Order targets for building: with vars.FAILED_FIRST, the ones whose
+    last build failed come first, for quick feedback; then, with
+    vars.CRITICAL_PATH, the ones with the longest path of builds still
+    to go below them (see _remaining).  Ties keep their order.
+    @param targets The target names
+    @return The names, in the order to build them
+    '''
+    files = state.File.bulk(targets)
+    memo = {}
+    def key(i):
+        f = files[i]
+        failed = vars.FAILED_FIRST and f.failed_runid != None
+        remaining = vars.CRITICAL_PATH and _remaining(f, memo) or 0
+        return (not failed, -remaining, i)
+    return [targets[i] for i in sorted(range(len(targets)), key=key)]
+
+
+def _remaining(f, memo):
+    '''
+    Estimate, from the times of the last builds, how long the longest
+    path of builds still to go below f takes.  A target's time takes in
+    the dependences it built, so its own share is what its time exceeds
+    its slowest dependence's by; the estimate adds to that the largest
+    estimate among its dependences.  Sources, and files already checked
+    in this run, count for nothing.  Like deps.isdirty, this walks the
+    graph with a stack of its own, so that chains of any depth work.
+    @param f The File
+    @param memo A map from file id to estimate, shared between calls
+    @return The estimate, in milliseconds
+    '''
+    stack = [(f, None)]
+    while stack:
+        (g, below) = stack.pop()
+        if below == None:
+            if g.id in memo:
+                continue
+            memo[g.id] = 0  # until we know better, so that a cycle ends
+            if not g.is_generated or g.is_checked():
+                continue
+            below = [dep for (key, members) in g.dep_sets()
+                     for (mode, dep) in members if mode == 'm']
+            stack.append((g, below))
+            stack.extend([(dep, None) for dep in below])
+        else:
+            slowest = max([dep.duration_ms or 0 for dep in below] + [0])
+            own = max((g.duration_ms or 0) - slowest, 0)
+            memo[g.id] = own + max([memo[dep.id] for dep in below] + [0])
+    return memo[f.id]
+
+
 def _print_cycle(target_list, t):
     n = len(target_list)
     for i in range(0, n):
@@ -427,6 +456,16 @@ def _print_cycle(target_list, t):
     err('  %s\n' % t)
 
 
+def _output_csum(t):
+    '''
+    @return The checksum of the target t's output, or None if it didn't
+    produce a regular file
+    '''
+    if not os.path.isfile(t):
+        return None
+    return file_digest(t, vars.CSUM_ALGO)
+
+
 def _try_stat(filename):
     try:
         return os.stat(filename)
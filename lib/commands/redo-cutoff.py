@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+# ======================================================================
+# redo-cutoff.py
+# Implement the redo-cutoff command
+# ======================================================================
+
+import sys, os
+import vars, state
+from log import err
+
+if len(sys.argv) > 1:
+    err('%s: no arguments expected.\n' % sys.argv[0])
+    sys.exit(1)
+
+if not vars.TARGET:
+    sys.exit(0)
+
+try:
+    me = os.path.join(vars.STARTDIR, 
+                      os.path.join(vars.PWD, vars.TARGET))
+    f = state.File(name=me)
+    f.cutoff_runid = vars.RUNID
+    f.save()
+    state.commit()
+except KeyboardInterrupt:
+    sys.exit(200)
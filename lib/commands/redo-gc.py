@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+# ======================================================================
+# redo-gc.py
+# Implement the redo-gc command
+# ======================================================================
+
+import sys, os, glob
+
+import vars_init
+vars_init.init([])
+
+import vars, state
+from log import err
+
+if len(sys.argv[1:]) != 0:
+    err('%s: no arguments expected.\n' % sys.argv[0])
+    sys.exit(1)
+
+
+def db_size():
+    '''
+    @return The total size of the database and its journals
+    '''
+    size = 0
+    for path in glob.glob(os.path.join(vars.BASE, '.redo', 'db.sqlite3*')):
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+
+try:
+    before = db_size()
+    result = state.gc()
+    if result == None:
+        err('%s: a build is running; try again when it is done.\n'
+            % sys.argv[0])
+        sys.exit(1)
+    (files, deps, runids, paths) = result
+    after = db_size()
+    print('removed %d files, %d dependencies, %d run ids, %d lock/cache files'
+          % (files, deps, runids, paths))
+    print('database: %d KB -> %d KB (%d KB reclaimed)'
+          % (before / 1024, after / 1024, (before - after) / 1024))
+except KeyboardInterrupt:
+    sys.exit(200)
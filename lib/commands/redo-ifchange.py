@@ -10,7 +10,7 @@ import sys, os
 import vars_init
 vars_init.init(sys.argv[1:])
 
-import vars, state, builder, jobs, deps
+import vars, state, builder, jobs, deps, fingerprint, zygote
 from log import debug, debug2, err
 
 def should_build(t):
@@ -40,10 +40,14 @@ try:
     try:
         targets = sys.argv[1:]
         if f:
-            for t in targets:
-                f.add_dep('m', t)
+            f.add_deps('m', targets)
             f.save()
-        rv = builder.main(targets, should_build)
+        if fingerprint.check(targets):
+            rv = 0
+        else:
+            zygote.start()
+            rv = builder.main(targets, should_build)
+            fingerprint.record(targets, rv)
     finally:
         jobs.force_return_tokens()
 except KeyboardInterrupt:
@@ -18,8 +18,7 @@ try:
         if os.path.exists(t):
             err('redo-ifcreate: error: %r already exists\n' % t)
             sys.exit(1)
-        else:
-            f.add_dep('c', t)
+    f.add_deps('c', sys.argv[1:])
     state.commit()
 except KeyboardInterrupt:
     sys.exit(200)
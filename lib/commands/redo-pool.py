@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# ======================================================================
+# redo-pool.py
+# Implement the redo-pool command
+# ======================================================================
+
+import sys, os, errno, fcntl
+import vars, jobs
+from helpers import atoi, close_on_exec
+from log import err, warn
+
+
+def trylock(fd, size):
+    '''
+    Lock one of a pool's slots, which are the first size bytes of fd,
+    if one is free
+    @return The slot, or None if they are all taken
+    '''
+    for slot in range(size):
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX|fcntl.LOCK_NB, 1, slot)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                continue  # someone else has it locked
+            raise
+        return slot
+    return None
+
+
+if len(sys.argv) < 4:
+    err('usage: %s name size command [args...]\n' % sys.argv[0])
+    sys.exit(1)
+
+(name, size, argv) = (sys.argv[1], atoi(sys.argv[2]), sys.argv[3:])
+if not name or '/' in name or name.startswith('.'):
+    err('%s: invalid pool name %r\n' % (sys.argv[0], name))
+    sys.exit(1)
+if size < 1:
+    err('%s: invalid pool size %r\n' % (sys.argv[0], sys.argv[2]))
+    sys.exit(1)
+
+try:
+    path = os.path.join(vars.BASE, '.redo', 'pool.' + name)
+    try:
+        fd = os.open(path, os.O_RDWR|os.O_CREAT, 0o666)
+    except OSError as e:
+        err('%s: %s\n' % (path, e.strerror))
+        sys.exit(1)
+    slot = trylock(fd, size)
+    if slot == None:
+        if vars.DEBUG_LOCKS:
+            warn('pool %s (WAITING)\n' % name)
+        # give up our job's token while we wait, so that jobs outside the
+        # pool can run; we get one back while holding the slot, which is
+        # safe because nobody waits for a slot holding a token
+        jobs.setup(1)
+        jobs.put_token()
+        # sleep in the kernel until one slot is free; the waiters spread
+        # over the slots by pid
+        slot = os.getpid() % size
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, slot)
+        except IOError as e:
+            if e.errno != errno.EDEADLK:
+                raise
+            err('%s: waiting for pool %s would deadlock\n'
+                % (sys.argv[0], name))
+            sys.exit(1)
+        jobs.get_token('pool ' + name)
+    if vars.DEBUG_LOCKS:
+        warn('pool %s (slot %d)\n' % (name, slot))
+    # the lock is ours until the command exits, as long as the command
+    # keeps the descriptor open
+    close_on_exec(fd, False)
+    try:
+        os.execvp(argv[0], argv)
+    except OSError as e:
+        err('%s: %s\n' % (argv[0], e.strerror))
+        sys.exit(127)
+except KeyboardInterrupt:
+    sys.exit(200)
@@ -20,5 +20,6 @@ if len(sys.argv[1:]) != 0:
 for f in state.files():
     if f.name.startswith('//'):
         continue  # special name, ignore
-    if not f.is_generated and f.read_stamp() != state.STAMP_MISSING:
+    if (not f.is_generated and
+        f.read_stamp() not in (state.STAMP_MISSING, state.STAMP_DIR)):
         print(f.nicename())
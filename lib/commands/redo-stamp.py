@@ -5,36 +5,50 @@
 # Implement the redo-stamp command
 # ======================================================================
 
-import sys, os
-import vars, state
-from log import err, debug2
-
-if len(sys.argv) > 1:
-    err('%s: no arguments expected.\n' % sys.argv[0])
-    sys.exit(1)
+import sys, os, time
+import options
+from helpers import csum_fd, csum_algo_ok
+
+optspec = """
+redo-stamp [-a algorithm] <data
+redo-stamp [-a algorithm] --file=path
+--
+f,file=       checksum the contents of this file instead of stdin
+a,algorithm=  the hashlib algorithm to use (default: sha1, or $REDO_CSUM_ALGO)
+"""
+o = options.Options(optspec)
+(opt, flags, extra) = o.parse(sys.argv[1:])
+
+if extra:
+    o.fatal('no arguments expected')
 
-if os.isatty(0):
+import vars, state
+from log import err, debug
+
+algo = opt.algorithm or vars.CSUM_ALGO
+if not csum_algo_ok(algo):
+    o.fatal('unknown checksum algorithm %r' % algo)
+
+if opt.file:
+    try:
+        fd = os.open(opt.file, os.O_RDONLY)
+    except OSError as e:
+        err('%s: %s: %s\n' % (sys.argv[0], opt.file, e.strerror))
+        sys.exit(1)
+elif os.isatty(0):
     err('%s: you must provide the data to stamp on stdin\n' % sys.argv[0])
     sys.exit(1)
-
-# hashlib is only available in python 2.5 or higher, but the 'sha' module
-# produces a DeprecationWarning in python 2.6 or higher.  We want to support
-# python 2.4 and above without any stupid warnings, so let's try using hashlib
-# first, and downgrade if it fails.
-try:
-    import hashlib
-except ImportError:
-    import sha
-    sh = sha.sha()
 else:
-    sh = hashlib.sha1()
-
-while 1:
-    b = os.read(0, 4096)
-    sh.update(b)
-    if not b: break
+    fd = 0
 
-csum = sh.hexdigest()
+start = time.time()
+csum = csum_fd(fd, algo)
+if vars.DEBUG >= 1:
+    secs = time.time() - start
+    size = os.fstat(fd).st_size
+    if size and secs:
+        debug('redo-stamp: %d bytes in %.3fs (%.1f MB/s)\n'
+              % (size, secs, size / secs / 1e6))
 
 if not vars.TARGET:
     sys.exit(0)
@@ -42,18 +56,8 @@ if not vars.TARGET:
 me = os.path.join(vars.STARTDIR, 
                   os.path.join(vars.PWD, vars.TARGET))
 f = state.File(name=me)
-changed = (csum != f.csum)
-debug2('%s: old = %s\n' % (f.name, f.csum))
-debug2('%s: sum = %s (%s)\n' % (f.name, csum,
-                                changed and 'changed' or 'unchanged'))
 f.is_generated = True
 f.is_override = False
-f.failed_runid = None
-if changed:
-    f.set_changed()  # update_stamp might not do this if the mtime is identical
-    f.csum = csum
-else:
-    # unchanged
-    f.set_checked()
+f.set_csum(csum)
 f.save()
 state.commit()
@@ -7,17 +7,32 @@
 
 import sys, os
 import options
-from helpers import atoi
+from helpers import atoi, atof, parse_size, csum_algo_ok
 
 optspec = """
 redo [targets...]
 --
-j,jobs=    maximum number of jobs to build at once
+j,jobs=    maximum number of jobs to build at once, or auto for one per CPU
+l,load-average=  don't start another job while the load is at least this
+max-memory=  don't start another job while at least this much memory is in use (bytes, with K/M/G/T, or a percentage)
+jobserver-style=  how to pass job tokens to sub-makes: pipe, or fifo as GNU make 4.4 does (default: pipe)
 d,debug    print dependency checks as they happen
 v,verbose  print commands as they are read from .do files (variables intact)
 x,xtrace   print commands as they are executed (variables expanded)
 k,keep-going  keep going as long as possible even if some targets fail
 shuffle    randomize the build order to find dependency bugs
+critical-path  start first the targets with the longest path of builds still to go below them, estimated from the last build times
+failed-first  start first the targets whose last build failed
+wal        keep the state database in write-ahead-log mode
+commit-window=  milliseconds over which to coalesce database commits
+stat-cache  stat each file only once per run, sharing the result among all redo processes
+content-stamps  don't rebuild for source files whose timestamp changed but whose contents didn't
+early-cutoff  don't rebuild for targets that were rebuilt with identical output, as if they called redo-cutoff
+csum-algorithm=  the hashlib algorithm for checksums and content stamps (default: sha1)
+graph      load the whole dependency graph into memory, instead of querying it file by file
+stat-threads=  stat the files under each target on this many threads before checking it
+fingerprint  skip the whole run if nothing has changed since the last successful run with the same targets
+zygote     run the redo commands in .do files in processes forked from a preloaded server, instead of starting python for each
 debug-locks  print messages about file locking (useful for debugging)
 debug-pids   print process ids as part of log messages (useful for debugging)
 version    print the current version and exit
@@ -31,6 +46,26 @@ if opt.version:
     import version
     print(version.TAG)
     sys.exit(0)
+if opt.jobserver_style not in (None, 'pipe', 'fifo'):
+    o.fatal('unknown jobserver style %r' % opt.jobserver_style)
+if opt.load_average != None:
+    if atof(opt.load_average) <= 0:
+        o.fatal('invalid --load-average value: %r' % opt.load_average)
+    os.environ['REDO_LOAD_AVERAGE'] = str(opt.load_average)
+if opt.max_memory != None:
+    if not parse_size(str(opt.max_memory)):
+        o.fatal('invalid --max-memory value: %r' % opt.max_memory)
+    os.environ['REDO_MAX_MEMORY'] = str(opt.max_memory)
+if opt.jobs == 'auto':
+    try:
+        j = len(os.sched_getaffinity(0))
+    except AttributeError:
+        j = os.cpu_count() or 1
+    j = min(j, 1000)
+else:
+    j = atoi(opt.jobs or 1)
+if j < 1 or j > 1000:
+    o.fatal('invalid --jobs value: %r' % opt.jobs)
 if opt.debug:
     os.environ['REDO_DEBUG'] = str(opt.debug or 0)
 if opt.verbose:
@@ -41,6 +76,32 @@ if opt.keep_going:
     os.environ['REDO_KEEP_GOING'] = '1'
 if opt.shuffle:
     os.environ['REDO_SHUFFLE'] = '1'
+if opt.critical_path:
+    os.environ['REDO_CRITICAL_PATH'] = '1'
+if opt.failed_first:
+    os.environ['REDO_FAILED_FIRST'] = '1'
+if opt.wal:
+    os.environ['REDO_WAL'] = '1'
+if opt.commit_window:
+    os.environ['REDO_COMMIT_WINDOW'] = str(atoi(opt.commit_window))
+if opt.stat_cache:
+    os.environ['REDO_STAT_CACHE'] = '1'
+if opt.content_stamps:
+    os.environ['REDO_CONTENT_STAMPS'] = '1'
+if opt.early_cutoff:
+    os.environ['REDO_EARLY_CUTOFF'] = '1'
+if opt.csum_algorithm:
+    if not csum_algo_ok(opt.csum_algorithm):
+        o.fatal('unknown checksum algorithm %r' % opt.csum_algorithm)
+    os.environ['REDO_CSUM_ALGO'] = opt.csum_algorithm
+if opt.graph:
+    os.environ['REDO_GRAPH'] = '1'
+if opt.stat_threads:
+    os.environ['REDO_STAT_THREADS'] = str(atoi(opt.stat_threads))
+if opt.fingerprint:
+    os.environ['REDO_FINGERPRINT'] = '1'
+if opt.zygote:
+    os.environ['REDO_ZYGOTE'] = '1'
 if opt.debug_locks:
     os.environ['REDO_DEBUG_LOCKS'] = '1'
 if opt.debug_pids:
@@ -49,8 +110,8 @@ if opt.debug_pids:
 import vars_init
 vars_init.init(targets)
 
-import vars, state, builder, jobs
-from log import warn, err
+import vars, state, builder, jobs, fingerprint, zygote
+from log import warn
 
 try:
     for t in targets:
@@ -60,14 +121,15 @@ try:
                 warn('%s: exists and not marked as generated; not redoing.\n'
                      % f.nicename())
     
-    j = atoi(opt.jobs or 1)
-    if j < 1 or j > 1000:
-        err('invalid --jobs value: %r\n' % opt.jobs)
-    jobs.setup(j)
+    if fingerprint.check(targets):
+        sys.exit(0)
+    jobs.setup(j, opt.jobserver_style or 'pipe')
+    zygote.start()
     try:
         retcode = builder.main(targets, lambda t: True)
     finally:
         jobs.force_return_tokens()
+    fingerprint.record(targets, retcode)
     sys.exit(retcode)
 except KeyboardInterrupt:
     sys.exit(200)
@@ -4,7 +4,7 @@
 # ======================================================================
 
 import sys, os
-import vars, state, builder
+import vars, state, dofiles
 from log import debug
 
 # ----------------------------------------------------------------------
@@ -26,7 +26,14 @@ def isdirty(
     set_checked=state.File.set_checked_save
 ):
     '''
-    Determine whether a file needs to be built
+    Determine whether a file needs to be built.  This walks the
+    dependences with an explicit stack, so chains of any depth work, and
+    remembers the verdict for each (file, max_changed) it sees, so
+    shared dependences are checked once per call; likewise for each
+    shared set of dependences (see state._intern).  With
+    vars.STAT_THREADS, it first stats every file it might look at, on
+    that many threads.  Each directory searched for .do files is
+    stat'ed once per call, and each file's row read once.
     @param f The file name
     @param depth The recursion depth
     @param max_changed The maximum changed run ID
@@ -35,6 +42,109 @@ def isdirty(
     @return One of the following: CLEAN (the file is clean); or
             DIRTY (the file is dirty); or a list of targets to build
     '''
+    dofiles.hold()
+    state.hold_rows()
+    try:
+        deplists = {}
+        if vars.STAT_THREADS:
+            deplists = _prefetch(f, is_checked)
+        return _walk(f, depth, max_changed, is_checked, set_checked,
+                     deplists)
+    finally:
+        state.clear_stamps()
+        state.release_rows()
+        dofiles.release()
+
+# ----------------------------------------------------------------------
+# Private functions
+# ----------------------------------------------------------------------
+
+def _max(a, b):
+    if a == None:
+        return b
+    elif b == None:
+        return a
+    else:
+        return max(a, b)
+
+
+def _prefetch(f, is_checked):
+    '''
+    Find the files that checking f might stat: the files under f, down
+    to the ones that are checked already or that _isdirty doesn't look
+    past, and the ones whose creation would make their targets dirty.
+    Then stat them all at once.
+    @return A map from file id to the dependences of the file, which we
+    had to read anyway
+    '''
+    deplists = {}
+    names = []
+    stack = [f]
+    seen = set([f.id])
+    while stack:
+        f = stack.pop()
+        if (f.failed_runid or f.changed_runid == None or is_checked(f)
+                or not f.stamp):
+            continue
+        names.append(f.name)
+        deplists[f.id] = f.dep_sets()
+        for mode,f2 in [dep for (key, deps) in deplists[f.id]
+                        for dep in deps]:
+            if mode == 'c':
+                names.append(f2.name)
+            elif mode == 'm' and f2.id not in seen:
+                seen.add(f2.id)
+                stack.append(f2)
+    state.prefetch_stamps(names, vars.STAT_THREADS)
+    return deplists
+
+
+def _walk(f, depth, max_changed, is_checked, set_checked, deplists):
+    memo = {}
+    setmemo = {}
+    # the files being checked, with their keys into memo
+    stack = [((f.id, max_changed),
+              _isdirty(f, depth, max_changed, is_checked, set_checked,
+                       deplists, setmemo))]
+    active = set([f.id])
+    status = None
+    while True:
+        (key, gen) = stack[-1]
+        try:
+            (f2, depth2, max_changed2) = gen.send(status)
+        except StopIteration as e:
+            status = e.value
+            memo[key] = status
+            active.discard(key[0])
+            stack.pop()
+            if not stack:
+                return status
+            continue
+        key2 = (f2.id, max_changed2)
+        if key2 in memo:
+            status = memo[key2]
+            if vars.DEBUG >= 1:
+                debug('%s?%s (seen)\n' % (depth2, f2.nicename()))
+        elif f2.id in active:
+            debug('%s-- DIRTY (cycle at %s)\n' % (depth2, f2.nicename()))
+            status = DIRTY
+        else:
+            stack.append((key2, _isdirty(f2, depth2, max_changed2,
+                                         is_checked, set_checked, deplists,
+                                         setmemo)))
+            active.add(f2.id)
+            status = None
+
+
+def _isdirty(f, depth, max_changed, is_checked, set_checked, deplists,
+             setmemo):
+    '''
+    Check one file for isdirty.  This is a generator: to check a
+    dependence, it yields (file, depth, max_changed), and the caller
+    sends back the verdict.  Its return value is the verdict for f.
+    deplists holds dependences that _prefetch has already read, and
+    setmemo the verdicts for the shared sets already checked.
+    '''
     if vars.DEBUG >= 1:
         debug('%s?%s\n' % (depth, f.nicename()))
 
@@ -56,6 +166,9 @@ def isdirty(
         return DIRTY
 
     newstamp = f.read_stamp()
+    if f.stamp != newstamp and f.same_content(newstamp):
+        debug('%s-- same content\n' % depth)
+        f.stamp = newstamp  # so we needn't hash it again
     if f.stamp != newstamp:
         if newstamp == state.STAMP_MISSING:
             debug('%s-- DIRTY (missing)\n' % depth)
@@ -65,30 +178,51 @@ def isdirty(
             return [f]
         else:
             return DIRTY
+    f.update_digest()
 
     targets = []
-    for mode,f2 in f.deps():
-        status = CLEAN
-        if mode == 'c' and os.path.exists(os.path.join(vars.BASE, f2.name)):
-            debug('%s-- DIRTY (created)\n' % depth)
-            status = DIRTY
-        elif mode == 'm':
-            def _max(a, b):
-                if a == None:
-                    return b
-                elif b == None:
-                    return a
-                else:
-                    return max(a, b)
-            sub = isdirty(f2, depth = depth + '  ',
-                          max_changed = _max(f.changed_runid,
-                                             f.checked_runid),
-                          is_checked=is_checked, set_checked=set_checked)
-            if sub:
-                debug('%s-- DIRTY (sub)\n' % depth)
-                status = sub
+    target_ids = set()
+    sets = deplists.get(f.id)
+    if sets == None:
+        sets = f.dep_sets()
+    used = None
+    sub_max = _max(f.changed_runid, f.checked_runid)
+    for (key, deps) in sets:
+        # every file with a set checks its members against its own
+        # max_changed, and combines their verdicts according to f.csum
+        setkey = (key, sub_max, not f.csum)
+        if key != None and setkey in setmemo:
+            status = setmemo[setkey]
+            if vars.DEBUG >= 1:
+                debug('%s-- set %d (seen)\n' % (depth, key))
         else:
-            assert(mode in ('c','m'))
+            status = CLEAN
+            for mode,f2 in deps:
+                sub = CLEAN
+                if mode == 'd' and used == None:
+                    used = set([os.path.normpath(os.path.join(vars.BASE,
+                                                              f3.name))
+                                for (k, deps3) in sets
+                                for (mode3, f3) in deps3 if mode3 == 'm'])
+                if mode == 'c' and f2.exists():
+                    debug('%s-- DIRTY (created)\n' % depth)
+                    sub = DIRTY
+                elif mode == 'd' and dofiles.created(f.name, f2.name, used):
+                    debug('%s-- DIRTY (new .do file in %s)\n'
+                          % (depth, f2.name))
+                    sub = DIRTY
+                elif mode == 'm':
+                    sub = yield (f2, depth + '  ', sub_max)
+                    if sub:
+                        debug('%s-- DIRTY (sub)\n' % depth)
+                else:
+                    assert(mode in ('c','d','m'))
+                status = _combine(f, status, sub)
+                if status == DIRTY or (status and not f.csum):
+                    break
+            # what a 'd' dependence means depends on the target's name
+            if key != None and 'd' not in [mode for (mode, f2) in deps]:
+                setmemo[setkey] = status
         if f.csum:
             # f is "checksummable": dirty f2 means f needs to redo,
             # but f might turn out to be clean after that (ie. our parent
@@ -101,8 +235,11 @@ def isdirty(
             elif isinstance(status, list):
                 # our child f2 might be dirty, but it's not sure yet.  It's
                 # given us a list of targets we have to redo in order to
-                # be sure.
-                targets += status
+                # be sure.  Children may share them, so skip duplicates.
+                for f3 in status:
+                    if f3.id not in target_ids:
+                        target_ids.add(f3.id)
+                        targets.append(f3)
         elif not status == CLEAN:
             # f is a "normal" target: dirty f2 means f is instantly dirty
             return status
@@ -121,3 +258,19 @@ def isdirty(
     return CLEAN
 
 
+def _combine(f, status, sub):
+    '''
+    Combine the verdicts for some of f's dependences, in the way f does
+    with the verdicts for all of them (see _isdirty)
+    @param status The verdict for the dependences so far
+    @param sub The verdict for the next one
+    @return The verdict for both
+    '''
+    if status == DIRTY or sub == CLEAN:
+        return status
+    if not f.csum:
+        return status or sub
+    if sub == DIRTY:
+        return DIRTY
+    ids = set([f3.id for f3 in status or []])
+    return (status or []) + [f3 for f3 in sub if f3.id not in ids]
@@ -0,0 +1,322 @@
+# ======================================================================
+# dofiles.py
+# Find the .do file for a target
+# ======================================================================
+
+import os, stat, time
+import vars, state, statcache
+from helpers import join
+from log import debug2
+
+# ----------------------------------------------------------------------
+# Private constants
+# ----------------------------------------------------------------------
+
+# A directory modified less than this long before we look at it may
+# change again without its mtime changing, so we don't trust a listing
+RACY_NS = 2 * 10**9
+
+# ----------------------------------------------------------------------
+# Private variables
+# ----------------------------------------------------------------------
+
+# A map from directory path to (mtime_ns, set of .do file names)
+_listings = {}
+# A map from target name to its candidate .do files (see _candidates)
+_groups = {}
+# A map from a target's directory to the directories to search (see
+# _search)
+_searches = {}
+# While a check holds them (see hold), a map from directory path to its
+# stamp (see _stamp); otherwise None
+_stamps = None
+
+# ----------------------------------------------------------------------
+# Public functions
+# ----------------------------------------------------------------------
+
+def find(f):
+    '''
+    Find the .do file for a target, and record the dependences that
+    finding it implies: on the .do file ('m'), and on each directory
+    where a candidate that doesn't exist was passed over ('d'), instead
+    of on each of those candidates
+    @param f The File of the target
+    @return (dodir, dofile, basedir, basename, ext), or five Nones if
+    there is no .do file
+    '''
+    dirs = []
+    for (dir, candidates) in _candidates(f.name):
+        names = listing(dir)
+        for (i, candidate) in enumerate(candidates):
+            (dodir, dofile, basedir, basename, ext) = candidate
+            dopath = os.path.join(dodir, dofile)
+            debug2('%s: %s:%s ?\n' % (f.name, dodir, dofile))
+            if _exists(dopath, names):
+                if i > 0:
+                    dirs.append(dir)  # a candidate before it might appear
+                f.add_deps('d', dirs)
+                f.add_dep('m', dopath)
+                return dodir,dofile,basedir,basename,ext
+        dirs.append(dir)
+    f.add_deps('d', dirs)
+    return None,None,None,None,None
+
+
+def created(target, dir, used):
+    '''
+    Check a 'd' dependence: whether searching a directory for target's
+    .do file would now find a different one
+    @param target The name of the target, relative to the base
+    @param dir The name of the directory, relative to the base
+    @param used The absolute, normalized paths of the files target
+    depends on, among them the .do file it was built with, if that
+    came from dir
+    @return Whether the first of target's candidate .do files to exist
+    in dir, if any, is not one target depends on
+    '''
+    dir = os.path.normpath(os.path.join(vars.BASE, dir))
+    names = listing(dir)
+    for (dodir, dofile) in _in_dir(target, dir):
+        # don't make the paths the listing rules out
+        if names != None and dofile not in names:
+            continue
+        path = os.path.join(dodir, dofile)
+        if _exists(path, names):
+            return os.path.normpath(path) not in used
+    return False
+
+
+def missing(target, dir):
+    '''
+    @param target The name of a target, relative to the base
+    @param dir The name of a directory, relative to the base
+    @return The paths of target's candidate .do files in dir that come
+    before the first one that exists, i.e., that must not exist for a
+    search of dir to find the same as it does now
+    '''
+    dir = os.path.normpath(os.path.join(vars.BASE, dir))
+    names = listing(dir)
+    paths = []
+    for (dodir, dofile) in _in_dir(target, dir):
+        path = os.path.join(dodir, dofile)
+        if _exists(path, names):
+            break
+        paths.append(path)
+    return paths
+
+
+def hold():
+    '''
+    Stat each directory at most once until release, instead of once for
+    every 'd' dependence on it.  isdirty holds the stamps while it
+    checks a target, during which it builds nothing.
+    '''
+    global _stamps
+    _stamps = {}
+
+
+def release():
+    '''
+    Stat directories again each time we need their stamps
+    '''
+    global _stamps
+    _stamps = None
+
+
+def forget(path):
+    '''
+    Make every process of this run stat a file's directory again, if the
+    file is a .do file that has just been built
+    @param path The absolute path name of the file
+    '''
+    if not path.endswith('.do'):
+        return
+    dir = os.path.normpath(os.path.dirname(path))
+    if _stamps != None:
+        _stamps.pop(dir, None)
+    if vars.STAT_CACHE:
+        statcache.forget(dir + '/')
+
+
+def listing(dir):
+    '''
+    List the .do files in a directory.  A listing is kept in memory and
+    in the state database, and used for as long as the directory's mtime
+    stays the same, so each directory is listed once instead of each
+    candidate being stat'ed for every target.  The directory itself is
+    stat'ed once per check (see hold), or once per run with the stat
+    cache.
+    @param dir The absolute, normalized path of the directory
+    @return The set of names, or None if the directory changed too
+    recently for a listing to be trusted
+    '''
+    (mtime_ns, isdir, unused) = _dir_stamp(dir)
+    if not isdir:
+        return frozenset()
+    cached = _listings.get(dir) or state.do_listing(dir)
+    if cached and cached[0] == mtime_ns:
+        _listings[dir] = cached
+        return cached[1]
+    # a shared stamp may be older than the directory, so don't store a
+    # listing under it
+    (mtime_ns, isdir, unused) = _stamp(dir + '/')
+    if not isdir:
+        return frozenset()
+    if time.time() * 1e9 - mtime_ns < RACY_NS:
+        return None
+    try:
+        names = frozenset([name for name in os.listdir(dir)
+                           if name.endswith('.do')])
+    except OSError:
+        return None
+    _listings[dir] = (mtime_ns, names)
+    state.set_do_listing(dir, mtime_ns, names)
+    return names
+
+# ----------------------------------------------------------------------
+# Private functions
+# ----------------------------------------------------------------------
+
+def _dir_stamp(dir):
+    '''
+    @return The stamp of a directory (see _stamp), from the stamps held
+    or the stat cache if they have it
+    '''
+    if _stamps != None:
+        stamp = _stamps.get(dir)
+        if stamp != None:
+            return stamp
+    # the trailing slash keeps the key apart from the directory's stamp
+    # as a dependence, which is STAMP_DIR
+    if vars.STAT_CACHE:
+        stamp = statcache.get(dir + '/', _stamp)
+    else:
+        stamp = _stamp(dir + '/')
+    if _stamps != None:
+        _stamps[dir] = stamp
+    return stamp
+
+
+def _stamp(path):
+    '''
+    @return (mtime_ns, 1, 0) if path is a directory, or (0, 0, 0) if it
+    isn't one or doesn't exist
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (0, 0, 0)
+    if not stat.S_ISDIR(st.st_mode):
+        return (0, 0, 0)
+    return (st.st_mtime_ns, 1, 0)
+
+
+def _exists(path, names):
+    '''
+    @param names The listing of path's directory, or None
+    @return Whether path exists; we only stat it if the listing has it,
+    because it might be a dangling symlink
+    '''
+    if names != None and os.path.basename(path) not in names:
+        return False
+    return os.path.exists(path)
+
+
+def _in_dir(t, dir):
+    '''
+    @return The (dodir, dofile) of t's candidate .do files in dir, in
+    order: the same as _candidates gives for dir, without making the
+    candidates for every other directory.  isdirty asks this once for
+    each 'd' dependence, so it must be cheap.
+    '''
+    (dirname, filename) = os.path.split(t)
+    if os.path.normpath(os.path.join(vars.BASE, dirname)) == dir:
+        found = [(os.path.join(vars.BASE, dirname), '%s.do' % filename)]
+    else:
+        found = None
+    t = os.path.normpath(os.path.join(vars.BASE, t))
+    (dirname, filename) = os.path.split(t)
+    for (d, levels) in _search(dirname):
+        if found != None and d != dir:
+            break
+        if d == dir:
+            return (found or []) + [(basedir, dofile)
+                                    for (basedir, subdir) in levels
+                                    for (dofile, basename, ext)
+                                    in _default_do_files(filename)]
+    return found or []
+
+
+def _candidates(t):
+    '''
+    @return A list of (directory, candidates) in the order to search
+    them, where candidates are the (dodir, dofile, basedir, basename,
+    ext) in that directory, in order
+    '''
+    groups = _groups.get(t)
+    if groups != None:
+        return groups
+    groups = []
+    for candidate in _possible_do_files(t):
+        # the top directory comes out as '', which means the current one
+        dir = os.path.normpath(candidate[0] or os.getcwd())
+        if not groups or groups[-1][0] != dir:
+            groups.append((dir, []))
+        groups[-1][1].append(candidate)
+    _groups[t] = groups
+    return groups
+
+
+def _default_do_files(filename):
+    l = filename.split('.')
+    for i in range(1,len(l)+1):
+        basename = join('.', l[:i])
+        ext = join('.', l[i:])
+        if ext: ext = '.' + ext
+        yield ("default%s.do" % ext), basename, ext
+
+
+def _possible_do_files(t):
+    dirname,filename = os.path.split(t)
+    yield (os.path.join(vars.BASE, dirname), "%s.do" % filename,
+           '', filename, '')
+
+    # It's important to try every possibility in a directory before resorting
+    # to a parent directory.  Think about nested projects: I don't want
+    # ../../default.o.do to take precedence over ../default.do, because
+    # the former one might just be an artifact of someone embedding my project
+    # into theirs as a subdir.  When they do, my rules should still be used
+    # for building my project in *all* cases.
+    t = os.path.normpath(os.path.join(vars.BASE, t))
+    dirname,filename = os.path.split(t)
+    for (dir, levels) in _search(dirname):
+        for (basedir, subdir) in levels:
+            for dofile,basename,ext in _default_do_files(filename):
+                yield (basedir, dofile,
+                       subdir, os.path.join(subdir, basename), ext)
+
+
+def _search(dirname):
+    '''
+    @param dirname The absolute, normalized directory of a target
+    @return A list of (directory, levels) in the order to search them
+    for the target's default*.do files, where levels are the (basedir,
+    subdir) that fall in that directory.  This depends only on dirname,
+    so it is made once for all the targets in a directory.
+    '''
+    search = _searches.get(dirname)
+    if search != None:
+        return search
+    search = []
+    dirbits = dirname.split('/')
+    for i in range(len(dirbits), -1, -1):
+        basedir = join('/', dirbits[:i])
+        subdir = join('/', dirbits[i:])
+        # the top directory comes out as '', which means the current one
+        dir = os.path.normpath(basedir or os.getcwd())
+        if not search or search[-1][0] != dir:
+            search.append((dir, []))
+        search[-1][1].append((basedir, subdir))
+    _searches[dirname] = search
+    return search
@@ -0,0 +1,117 @@
+# ======================================================================
+# fingerprint.py
+# Skip runs that would find nothing to do
+# ======================================================================
+
+import os, errno, marshal, time
+import vars, state, dofiles
+from helpers import join
+from log import debug
+
+# ----------------------------------------------------------------------
+# Private constants
+# ----------------------------------------------------------------------
+
+# The format of fingerprint files; change it when they change
+FORMAT = 1
+
+# ----------------------------------------------------------------------
+# Public functions
+# ----------------------------------------------------------------------
+
+def check(targets):
+    '''
+    Determine whether a run can be skipped: the last run with the same
+    targets succeeded, no redo has built or checked anything since, and
+    every file the targets depend on still has the stamp it had then
+    @param targets The target names, as given on the command line
+    @return Whether nothing needs to be done
+    '''
+    if not _enabled():
+        return False
+    start = time.time()
+    try:
+        with open(_path(targets), 'rb') as f:
+            (format, runids, names, stamps) = marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return False  # none, or unreadable
+    if format != FORMAT or tuple(runids) != state.last_runids():
+        debug('fingerprint: the state database has changed\n')
+        return False
+    current = state.read_stamps(list(set(names)), vars.STAT_THREADS)
+    for (name, stamp) in zip(names, stamps):
+        if current[name] != tuple(stamp):
+            debug('fingerprint: %s has changed\n' % name)
+            return False
+    debug('fingerprint: %d files unchanged, checked in %.3fs\n'
+          % (len(names), time.time() - start))
+    return True
+
+
+def record(targets, retcode):
+    '''
+    Record the fingerprint of a run that has finished, so the next run
+    with the same targets can skip checking them
+    @param targets The target names, as given on the command line
+    @param retcode The run's exit code; a failed run forgets the
+    fingerprint instead
+    '''
+    if not _enabled():
+        return
+    path = _path(targets)
+    state.commit()
+    entries = retcode == 0 and _entries(targets)
+    if not entries:
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return
+    runids = state.last_runids()
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        marshal.dump((FORMAT, runids,
+                      [name for (name, stamp) in entries],
+                      [stamp for (name, stamp) in entries]), f)
+    os.rename(tmp, path)
+    debug('fingerprint: recorded %d files\n' % len(entries))
+
+# ----------------------------------------------------------------------
+# Private functions
+# ----------------------------------------------------------------------
+
+def _enabled():
+    # only the redo that started the run knows when it's over
+    return vars.FINGERPRINT and not vars.TARGET
+
+
+def _path(targets):
+    import hashlib
+    names = sorted([state.relpath(t, vars.BASE) for t in targets])
+    key = hashlib.sha1(join('\0', names).encode('utf-8', 'surrogateescape'))
+    return os.path.join(vars.BASE, '.redo', 'fingerprint.' + key.hexdigest())
+
+
+def _entries(targets):
+    '''
+    @return A list of (name, stamp) for every file the targets depend on,
+    with STAMP_MISSING for the files that must not exist; or None if the
+    targets aren't all up to date, or depend on something that always
+    is out of date
+    '''
+    entries = []
+    files = [state.File(name=t) for t in targets]
+    for (mode, f, target) in state.closure(files):
+        if mode == 'c':
+            entries.append((f.name, state.STAMP_MISSING))
+        elif mode == 'd':
+            for path in dofiles.missing(target.name, f.name):
+                entries.append((state.relpath(path, vars.BASE),
+                                state.STAMP_MISSING))
+        elif (f.name == state.ALWAYS or f.failed_runid
+              or f.changed_runid == None or not f.stamp):
+            return None
+        else:
+            entries.append((f.name, f.stamp))
+    return entries
@@ -0,0 +1,151 @@
+# ======================================================================
+# graph.py
+# An in-memory snapshot of the dependency graph
+# ======================================================================
+
+import sys
+from array import array
+from itertools import accumulate
+from helpers import join
+
+# ----------------------------------------------------------------------
+# Private constants
+# ----------------------------------------------------------------------
+
+# Stands for NULL in the integer columns
+NULL = -2**63
+# The columns that don't hold integers
+TEXT_COLS = ('name', 'csum', 'digest', 'depsets')
+
+# ----------------------------------------------------------------------
+# Public classes
+# ----------------------------------------------------------------------
+
+class Graph(object):
+    '''
+    The Files and Deps tables, loaded with one scan of each.  Integer
+    columns are arrays indexed by rowid, text columns are packed into
+    one buffer each (see _Texts), and the dependences of each target are
+    a slice of one array of sources (compressed sparse rows), so a large
+    graph takes a few dozen bytes per file and per dependence, plus its
+    text.
+    '''
+    __slots__ = ['cols', 'ids', 'version', 'nfiles', 'ndeps',
+                 '_present', '_columns', '_offsets', '_sources', '_modes']
+
+    def __init__(self, files, deps, cols, version):
+        '''
+        @param files The Files rows, as lists of the columns cols; the
+        first column is the rowid
+        @param deps A list of the Deps rows, as (target, source, mode), in
+        order of target
+        @param cols The column names of the Files rows
+        @param version The database's data_version when they were read
+        '''
+        self.cols = cols
+        self.version = version
+        columns = list(zip(*files)) or [()] * len(cols)
+        ids = columns[0]
+        n = max(ids + (deps and deps[-1][0] or 0,)) + 1
+        self.nfiles = len(ids)
+        self._present = bytearray(n)
+        for id in ids:
+            self._present[id] = 1
+        self._columns = []
+        for (col, column) in zip(cols, columns):
+            if col in TEXT_COLS:
+                values = _Texts(n, zip(ids, column))
+            else:
+                values = array('q', [NULL]) * n
+                for (id, v) in zip(ids, column):
+                    if v != None:
+                        values[id] = v
+            self._columns.append(values)
+        self.ids = dict(zip(columns[cols.index('name')], ids))
+        # _sources[_offsets[id]:_offsets[id+1]] are the sources of id
+        self._offsets = array('l', [0]) * (n + 1)
+        for (target, source, mode) in deps:
+            self._offsets[target+1] += 1
+        for i in range(n):
+            self._offsets[i+1] += self._offsets[i]
+        self._sources = array('l', [source for (target, source, mode) in deps])
+        self._modes = bytearray(join('', [mode for (target, source, mode)
+                                          in deps]), 'ascii')
+        self.ndeps = len(self._sources)
+
+    def row(self, id):
+        '''
+        @return The Files row for id, or None if it isn't in the snapshot
+        '''
+        if id == None or id >= len(self._present) or not self._present[id]:
+            return None
+        return tuple([None if v == NULL else v
+                      for v in [values[id] for values in self._columns]])
+
+    def deps(self, id):
+        '''
+        @return A list of (mode, source id) for the dependences of id
+        '''
+        if id >= len(self._present):
+            return []
+        start = self._offsets[id]
+        end = self._offsets[id+1]
+        return [(chr(self._modes[i]), self._sources[i])
+                for i in range(start, end)]
+
+    def size(self):
+        '''
+        @return An estimate of the memory the snapshot takes, in bytes
+        '''
+        size = sys.getsizeof(self._present) + sys.getsizeof(self._modes)
+        for a in [self._offsets, self._sources] + self._columns:
+            if isinstance(a, _Texts):
+                size += a.size()
+            else:
+                size += sys.getsizeof(a)
+        size += sys.getsizeof(self.ids)
+        for name in self.ids:
+            size += sys.getsizeof(name)
+        return size
+
+# ----------------------------------------------------------------------
+# Private classes
+# ----------------------------------------------------------------------
+
+class _Texts(object):
+    '''
+    A text column, indexed by rowid: the encoded strings, one after
+    another in one buffer, with an array of where each starts, instead
+    of a Python string per file
+    '''
+    __slots__ = ['_offsets', '_data', '_null']
+
+    def __init__(self, n, values):
+        '''
+        @param n One more than the highest rowid
+        @param values The (rowid, string or None) of each file
+        '''
+        # the value of id is _data[_offsets[id]:_offsets[id+1]], or None
+        # if _null[id] is set
+        self._null = bytearray(b'\x01') * n
+        parts = [b''] * n
+        for (id, v) in values:
+            if v != None:
+                parts[id] = v.encode('utf-8', 'surrogateescape')
+                self._null[id] = 0
+        self._offsets = array('l', [0])
+        self._offsets.extend(accumulate(map(len, parts)))
+        self._data = b''.join(parts)
+
+    def __getitem__(self, id):
+        if self._null[id]:
+            return None
+        return self._data[self._offsets[id]:self._offsets[id+1]].decode(
+            'utf-8', 'surrogateescape')
+
+    def size(self):
+        '''
+        @return The memory the column takes, in bytes
+        '''
+        return (sys.getsizeof(self._offsets) + sys.getsizeof(self._data) +
+                sys.getsizeof(self._null))
@@ -3,7 +3,12 @@
 # Helper functions for redo implementation
 # ======================================================================
 
-import os, errno, fcntl, shutil
+import os, errno, fcntl, stat, mmap
+
+# The buffer size for checksumming data we can't map into memory
+CSUM_BUFSIZE = 1024*1024
+# The suffixes parse_size understands, and what they multiply by
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
 
 def atoi(v):
     """
@@ -15,6 +20,39 @@ def atoi(v):
         return 0
 
 
+def atof(v):
+    """
+    Convert ascii to float
+    """
+    try:
+        return float(v or 0)
+    except ValueError:
+        return 0.0
+
+
+def parse_size(v):
+    """
+    Parse a size: a number of bytes, with an optional suffix K, M, G or T
+    (powers of 1024, either case), or a percentage
+    @return The pair (number, is_percentage), or None if v is neither
+    """
+    v = (v or '').strip()
+    percent = v.endswith('%')
+    scale = 1
+    if percent:
+        v = v[:-1]
+    elif v[-1:].upper() in SIZE_SUFFIXES:
+        scale = SIZE_SUFFIXES[v[-1:].upper()]
+        v = v[:-1]
+    try:
+        n = float(v)
+    except ValueError:
+        return None
+    if n <= 0 or n != n:
+        return None
+    return (n * scale, percent)
+
+
 def join(between, l):
     """
     join between and l
@@ -39,6 +77,7 @@ def remove(path):
     if os.path.isfile(path):
         os.unlink(path)
     elif os.path.isdir(path):
+        import shutil  # slow to import, and rarely needed
         shutil.rmtree(path)
       
 
@@ -53,3 +92,55 @@ def close_on_exec(fd, yes):
     fcntl.fcntl(fd, fcntl.F_SETFD, fl)
 
 
+def csum_algo_ok(algo):
+    """
+    Determine whether csum_fd can use a hashlib algorithm
+    """
+    import hashlib
+    try:
+        hashlib.new(algo).hexdigest()
+    except (ValueError, TypeError):
+        return False
+    return True
+
+
+def csum_fd(fd, algo='sha1'):
+    """
+    Checksum everything that can be read from fd.  A regular file is
+    mapped into memory; anything else is read in large chunks.  SHA-1
+    checksums are plain hex, as they always were; checksums made with
+    any other hashlib algorithm are 'algo:hex'.
+    """
+    import hashlib
+    h = hashlib.new(algo)
+    st = os.fstat(fd)
+    if (stat.S_ISREG(st.st_mode) and st.st_size > 0 and
+        os.lseek(fd, 0, os.SEEK_CUR) == 0):
+        m = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        try:
+            h.update(m)
+        finally:
+            m.close()
+    else:
+        buf = bytearray(CSUM_BUFSIZE)
+        view = memoryview(buf)
+        f = os.fdopen(fd, 'rb', 0, closefd=False)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    if algo == 'sha1':
+        return h.hexdigest()
+    return '%s:%s' % (algo, h.hexdigest())
+
+
+def file_digest(path, algo='sha1'):
+    """
+    Checksum the contents of a file, as csum_fd does
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return csum_fd(fd, algo)
+    finally:
+        os.close(fd)
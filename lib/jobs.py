@@ -3,9 +3,18 @@
 # Manage redo jobs
 # ====================================================================== 
 
-import sys, os, errno, select, fcntl, signal
+import sys, os, errno, stat, select, selectors, fcntl, signal
+import vars
 from helpers import atoi, close_on_exec
 
+# ----------------------------------------------------------------------
+# Private constants
+# ----------------------------------------------------------------------
+
+# How long to wait, while the system is too busy for us to start another
+# job, before looking again whether it still is
+OVERLOAD_WAIT = 0.5
+
 # ----------------------------------------------------------------------
 # Private variables
 # ----------------------------------------------------------------------
@@ -16,8 +25,19 @@ _toplevel = 0
 _has_token = True
 # A pair of (read, write) file descriptors for passing tokens between processes
 _pipe = None
+# Whether reading _pipe[0] can block, because other processes share its
+# open file, so we can't make it non-blocking
+_blocking = True
+# The path of the named pipe, if we made one (see _make_fifo)
+_fifo = None
 # A map from file descriptors to pending job completions
 _completion_map = {}
+# The selector (epoll, where there is one) on which the read ends of the
+# completion pipes stay registered while their jobs run, so a wait costs
+# the same however many jobs are running
+_selector = None
+# The process that _selector belongs to; a forked child makes its own
+_selector_pid = None
 
 # ----------------------------------------------------------------------
 # Private classes
@@ -44,25 +64,36 @@ class Completion:
 # Public functions
 # ----------------------------------------------------------------------
 
-def setup(maxjobs):
+def setup(maxjobs, style='pipe'):
     """
-    Initialize the jobs state
+    Initialize the jobs state: join the jobserver that MAKEFLAGS names,
+    or else, if maxjobs is given, start one
+    @param maxjobs The number of tokens for a new jobserver
+    @param style How a new jobserver passes tokens: 'pipe', through a
+    pipe whose descriptors children inherit (--jobserver-fds=R,W), as
+    every GNU make understands; or 'fifo', through a named pipe that
+    each of them opens (--jobserver-auth=fifo:PATH), as GNU make 4.4
+    does by default
     """
     global _pipe, _toplevel
     if _pipe:
         return  # Already set up
     _debug('setup(%d)\n' % maxjobs)
-    flags = ' ' + os.getenv('MAKEFLAGS', '') + ' '
-    FIND = ' --jobserver-fds='
-    ofs = flags.find(FIND)
-    if ofs >= 0:
-        s = flags[ofs+len(FIND):]
-        (arg,junk) = s.split(' ', 1)
-        (a,b) = arg.split(',', 1)
+    auth = _jobserver_auth(os.getenv('MAKEFLAGS', ''))
+    if auth == None:
+        pass
+    elif auth.startswith('fifo:'):
+        try:
+            _pipe = _open_fifo(auth[len('fifo:'):])
+        except OSError as e:
+            raise ValueError('cannot open the jobserver fifo %r: %s'
+                             % (auth[len('fifo:'):], e.strerror))
+    else:
+        (a,b) = (auth + ',').split(',')[:2]
         a = atoi(a)
         b = atoi(b)
         if a <= 0 or b <= 0:
-            raise ValueError('invalid --jobserver-fds: %r' % arg)
+            raise ValueError('invalid --jobserver-fds: %r' % auth)
         try:
             fcntl.fcntl(a, fcntl.F_GETFL)
             fcntl.fcntl(b, fcntl.F_GETFL)
@@ -71,15 +102,21 @@ def setup(maxjobs):
                 raise ValueError('broken --jobserver-fds from make; prefix your Makefile rule with a "+"')
             else:
                 raise
-        _pipe = (a,b)
+        _pipe = (_own_reader(a), b)
     if maxjobs and not _pipe:
         # Start a new server
         _toplevel = maxjobs
-        _pipe = _make_pipe(100)
+        if style == 'fifo' and maxjobs > 1:
+            _pipe = _make_fifo()
+            if _pipe:
+                auth = '--jobserver-auth=fifo:%s' % _fifo
+        if not _pipe:
+            (a,b) = _make_pipe(100)
+            _pipe = (_own_reader(a), b)
+            auth = '--jobserver-fds=%d,%d' % (a, b)
         _put_tokens(maxjobs-1)
         os.putenv('MAKEFLAGS',
-                  '%s --jobserver-fds=%d,%d -j' % (os.getenv('MAKEFLAGS'),
-                                                    _pipe[0], _pipe[1]))
+                  '%s %s -j' % (os.getenv('MAKEFLAGS', ''), auth))
 
 def put_token():
     """
@@ -100,7 +137,9 @@ def has_token():
 
 def get_token(reason):
     """
-    Get a token
+    Get a token.  While this process has jobs running and the system is
+    too busy (see _overloaded), it only takes back the tokens of its own
+    jobs, so every process can always run at least one.
     @param reason The reason for the token
     """
     global _has_token
@@ -109,6 +148,9 @@ def get_token(reason):
     # Loop until we get a token
     while not _has_token:
         _debug('(%r) waiting for token...\n' % reason)
+        if _completion_map and _overloaded():
+            _wait(None, OVERLOAD_WAIT)
+            continue
         # Wait for internal or external work to become available
         _wait_internal_or_external()
         if not _has_token:
@@ -145,8 +187,8 @@ def wait_all():
         bb = b''
         while 1:
             b = _try_read(_pipe[0], 8192)
+            if not b: break  # none left, or EOF
             bb += b
-            if not b: break
         if len(bb) != _toplevel-1:
             raise Exception('on exit: expected %d tokens; found %r' 
                             % (_toplevel-1, len(bb)))
@@ -164,6 +206,7 @@ def force_return_tokens():
     _debug('returning %d tokens\n' % n)
     for k in list(_completion_map):
         del _completion_map[k]
+        _get_selector().unregister(k)
     if _pipe:
         _put_tokens(n)
 
@@ -201,6 +244,7 @@ def start_job(name, jobfunc, donefunc):
     os.close(w)
     # Add the job completion to _completion_map
     _completion_map[r] = Completion(name, pid, donefunc)
+    _get_selector().register(r, selectors.EVENT_READ)
 
 # ----------------------------------------------------------------------
 # Private functions
@@ -212,25 +256,32 @@ def _wait_internal_or_external():
     Internal work is the completion of a build started by this process.
     External work is a token placed on _pipe[0] by this or another process.
     """
-    rfds = list(_completion_map)
-    if _pipe:
-        rfds.append(_pipe[0])
-    _wait(rfds)
+    _wait(_pipe and _pipe[0])
 
 def _wait_internal_only():
     """
     Wait for internal work only.
     """
-    rfds = list(_completion_map)
-    _wait(rfds)
+    _wait(None)
 
-def _wait(rfds):
+def _wait(tokenfd, timeout=None):
     """
     Wait for work to become available.
-    @rfds Read file descriptors on which to wait
+    @param tokenfd The file descriptor to wait on for tokens too, or None
+    @param timeout The most seconds to wait, or None to wait until there
+    is work
     """
-    assert(rfds)
-    r,w,x = select.select(rfds, [], [])
+    assert(_completion_map or tokenfd != None)
+    sel = _get_selector()
+    # the token pipe is readable whenever there are tokens, so it's only
+    # registered while we want them
+    if tokenfd != None:
+        sel.register(tokenfd, selectors.EVENT_READ)
+    try:
+        r = [key.fd for (key, events) in sel.select(timeout)]
+    finally:
+        if tokenfd != None:
+            sel.unregister(tokenfd)
     _debug('_pipe=%r; _completion_map=%r; readable: %r\n' % (_pipe, _completion_map, r))
     for fd in r:
         if _pipe and fd == _pipe[0]:
@@ -243,6 +294,7 @@ def _wait(rfds):
             # Get a token if we don't already have one.
             # Otherwise put it on the pipe.
             _put_tokens(1)
+            sel.unregister(fd)
             os.close(fd)
             del _completion_map[fd]
             # Wait for the job process to finish
@@ -259,6 +311,98 @@ def _wait(rfds):
             completion.donefunc(completion.name, completion.rv)
 
 
+def _overloaded():
+    """
+    @return Whether the system is too busy for us to start another job:
+    its load is at least vars.LOAD_AVERAGE, or the memory in use is at
+    least vars.MAX_MEMORY
+    """
+    if vars.LOAD_AVERAGE:
+        load = _load()
+        if load != None and load >= vars.LOAD_AVERAGE:
+            _debug('load %r\n' % load)
+            return True
+    if vars.MAX_MEMORY:
+        memory = _memory()
+        if memory:
+            (total, available) = memory
+            (limit, percent) = vars.MAX_MEMORY
+            if percent:
+                limit = total * limit / 100
+            if total - available >= limit:
+                _debug('memory in use %r\n' % (total - available))
+                return True
+    return False
+
+
+def _load():
+    """
+    @return The load: on Linux, as GNU make counts it, the number of
+    other processes running or ready to run now, because the one-minute
+    average lags far behind the jobs we start; elsewhere, that average;
+    or None if we can't tell
+    """
+    try:
+        with open('/proc/loadavg') as f:
+            # e.g., 0.52 0.58 0.59 2/415 12345
+            return int(f.read().split()[3].split('/')[0]) - 1
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    try:
+        return os.getloadavg()[0]
+    except (OSError, AttributeError):
+        return None
+
+
+def _memory():
+    """
+    @return The pair (total, available) of the system's memory in bytes,
+    from /proc/meminfo, or None if we can't tell
+    """
+    info = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                # e.g., MemTotal:       16318412 kB
+                fields = line.split()
+                if len(fields) >= 2:
+                    info[fields[0].rstrip(':')] = atoi(fields[1]) * 1024
+    except (IOError, OSError):
+        return None
+    if 'MemAvailable' not in info:
+        # before Linux 3.14: roughly what it counts
+        info['MemAvailable'] = (info.get('MemFree', 0) +
+                                info.get('Buffers', 0) +
+                                info.get('Cached', 0))
+    if not info.get('MemTotal'):
+        return None
+    return (info['MemTotal'], info['MemAvailable'])
+
+
+def _get_selector():
+    """
+    @return The selector for this process
+    """
+    global _selector, _selector_pid
+    if _selector_pid != os.getpid():
+        _selector = selectors.DefaultSelector()
+        _selector_pid = os.getpid()
+    return _selector
+
+
+def _readable(fd):
+    """
+    @return Whether fd can be read from now; unlike select.select, this
+    works for any file descriptor number
+    """
+    if hasattr(select, 'poll'):
+        p = select.poll()
+        p.register(fd, select.POLLIN)
+        return bool(p.poll(0))
+    r,w,x = select.select([fd], [], [], 0)
+    return bool(r)
+
+
 def _debug(s):
     if 0:
         sys.stderr.write('jobs#%d: %s' % (os.getpid(),s))
@@ -282,6 +426,97 @@ def _put_tokens(n):
         os.write(_pipe[1], ('t' * num_to_put).encode())
 
 
+def _jobserver_auth(flags):
+    """
+    @param flags The value of MAKEFLAGS
+    @return The jobserver it names, as 'R,W' or 'fifo:PATH', or None
+    """
+    auth = None
+    # make uses the last one, as do we
+    for word in flags.split():
+        for prefix in ('--jobserver-auth=', '--jobserver-fds='):
+            if word.startswith(prefix):
+                auth = word[len(prefix):]
+    return auth
+
+
+def _own_reader(fd):
+    """
+    Open a pipe again, so that we can read it without blocking but
+    without making it non-blocking for the other processes that share
+    fd, which GNU make can't handle; on Linux, /proc lets us
+    @param fd The read end of the pipe
+    @return The new descriptor, or fd if we couldn't open one
+    """
+    global _blocking
+    try:
+        if stat.S_ISFIFO(os.fstat(fd).st_mode):
+            fd = os.open('/proc/self/fd/%d' % fd, os.O_RDONLY | os.O_NONBLOCK)
+            # ours alone, like _open_fifo's; children get the shared one
+            close_on_exec(fd, True)
+            _blocking = False
+    except OSError:
+        pass
+    return fd
+
+
+def _open_fifo(path):
+    """
+    Open a named pipe for reading, without blocking, and for writing.
+    The descriptors are ours alone, so they close when we exec.
+    @return The pair (read, write)
+    """
+    global _blocking
+    r = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        w = os.open(path, os.O_WRONLY)
+    except OSError:
+        os.close(r)
+        raise
+    close_on_exec(r, True)
+    close_on_exec(w, True)
+    _blocking = False
+    return (r, w)
+
+
+def _make_fifo():
+    """
+    Make a named pipe in a new temporary directory, open it, and arrange
+    to remove it when this process exits
+    @return The pair (read, write), or None if we couldn't
+    """
+    global _fifo
+    import tempfile, atexit
+    try:
+        dir = tempfile.mkdtemp(prefix='redo-jobserver-')
+    except (IOError, OSError) as e:
+        _debug('mkdtemp: %s\n' % e)
+        return None
+    path = os.path.join(dir, 'fifo')
+    pid = os.getpid()
+    def remove():
+        if os.getpid() != pid:
+            return  # a forked child exiting
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        try:
+            os.rmdir(dir)
+        except OSError:
+            pass
+    try:
+        os.mkfifo(path, 0o600)
+        fds = _open_fifo(path)
+    except OSError as e:
+        _debug('%s: %s\n' % (path, e))
+        remove()
+        return None
+    atexit.register(remove)
+    _fifo = path
+    return fds
+
+
 def _timeout(sig, frame):
     pass
 
@@ -302,14 +537,24 @@ def _make_pipe(startfd):
 
 def _try_read(fd, n):
     """
-    Read n bytes from fd
+    Read up to n tokens from fd, if there are any
+    @return The tokens; b'' if there weren't any; or None at EOF
     """
+    if not _blocking:
+        # our own non-blocking descriptor: if someone else got there
+        # first, we just find nothing
+        try:
+            b = os.read(fd, n)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return b''  # Try again
+            raise
+        return b and b or None  # None means EOF
     # Using djb's suggested way of doing non-blocking reads from a blocking
     # socket: http://cr.yp.to/unix/nonblock.html
     # We can't just make the socket non-blocking, because we want to be
     # compatible with GNU Make, and they can't handle it.
-    r,w,x = select.select([fd], [], [], 0)
-    if not r:
+    if not _readable(fd):
         return b''  # try again
     # Ok, the socket is readable - but some other process might get there
     # first.  We have to set an alarm() in case our read() gets stuck.
@@ -317,7 +562,7 @@ def _try_read(fd, n):
     try:
         signal.alarm(1)  # Emergency fallback
         try:
-            b = os.read(_pipe[0], 1)
+            b = os.read(fd, n)
         except OSError as e:
             if e.errno in (errno.EAGAIN, errno.EINTR):
                 # Interrupted or it was nonblocking
@@ -328,5 +573,3 @@ def _try_read(fd, n):
         signal.alarm(0)
         signal.signal(signal.SIGALRM, oldh)
     return b and b or None  # None means EOF
-
-
@@ -59,7 +59,9 @@ Options can be put in different groups. Options in the same group must be on
 consecutive lines. Groups are formed by inserting a line that begins with a
 space. The text on that line will be output after an empty line.
 """
-import sys, os, textwrap, getopt, re, struct
+# getopt and textwrap import re, which takes longer than the rest of a
+# redo command's startup, so they're imported only when needed
+import sys, os, struct
 
 class OptDict:
     """Dictionary that exposes keys as attributes.
@@ -115,6 +117,17 @@ def _remove_negative_k(k):
     return _remove_negative_kv(k, None)[0]
 
 
+def _default_value(extra):
+    """Return the text in the square brackets that end extra, or None."""
+    if not extra.endswith(']'):
+        return None
+    body = extra[:-1]
+    i = body.find('[', body.rfind(']') + 1)
+    if i < 0:
+        return None
+    return body[i+1:]
+
+
 def _tty_width():
     s = struct.pack("HHHH", 0, 0, 0, 0)
     try:
@@ -138,7 +151,7 @@ class Options:
     By default, the parser function is getopt.gnu_getopt, and the abort
     behaviour is to exit the program.
     """
-    def __init__(self, optspec, optfunc=getopt.gnu_getopt,
+    def __init__(self, optspec, optfunc=None,
                  onabort=_default_onabort):
         self.optspec = optspec
         self._onabort = onabort
@@ -148,7 +161,7 @@ class Options:
         self._longopts = ['help', 'usage']
         self._hasparms = {}
         self._defaults = {}
-        self._usagestr = self._gen_usage()
+        self._usage = self._gen_usage()
 
     def _gen_usage(self):
         out = []
@@ -176,11 +189,7 @@ class Options:
                     has_parm = 1
                 else:
                     has_parm = 0
-                g = re.search(r'\[([^\]]*)\]$', extra)
-                if g:
-                    defval = g.group(1)
-                else:
-                    defval = None
+                defval = _default_value(extra)
                 flagl = flags.split(',')
                 flagl_nice = []
                 for _f in flagl:
@@ -195,7 +204,8 @@ class Options:
                         self._shortopts += f + (has_parm and ':' or '')
                         flagl_nice.append('-' + f)
                     else:
-                        f_nice = re.sub(r'\W', '_', f)
+                        f_nice = ''.join([(c.isalnum() and c or '_')
+                                          for c in f])
                         self._aliases[f_nice] = _remove_negative_k(flagl[0])
                         self._longopts.append(f + (has_parm and '=' or ''))
                         self._longopts.append('no-' + f)
@@ -203,20 +213,30 @@ class Options:
                 flags_nice = ', '.join(flagl_nice)
                 if has_parm:
                     flags_nice += ' ...'
-                prefix = '    %-20s  ' % flags_nice
-                argtext = '\n'.join(textwrap.wrap(extra, width=_tty_width(),
-                                                initial_indent=prefix,
-                                                subsequent_indent=' '*28))
-                out.append(argtext + '\n')
+                # wrapped when the usage is printed (see _usagestr)
+                out.append(('    %-20s  ' % flags_nice, extra))
                 last_was_option = True
             else:
                 out.append('\n')
                 last_was_option = False
+        return out
+
+    def _usagestr(self):
+        import textwrap
+        out = []
+        for piece in self._usage:
+            if isinstance(piece, tuple):
+                (prefix, extra) = piece
+                piece = '\n'.join(textwrap.wrap(extra, width=_tty_width(),
+                                                initial_indent=prefix,
+                                                subsequent_indent=' '*28))
+                piece += '\n'
+            out.append(piece)
         return ''.join(out).rstrip() + '\n'
 
     def usage(self, msg=""):
         """Print usage string to stderr and abort."""
-        sys.stderr.write(self._usagestr)
+        sys.stderr.write(self._usagestr())
         if msg:
             sys.stderr.write(msg)
         e = self._onabort and self._onabort(msg) or None
@@ -235,10 +255,15 @@ class Options:
         "flags" is a list of option flags that were used on the command-line,
         and "extra" is a list of positional arguments.
         """
-        try:
-            (flags,extra) = self.optfunc(args, self._shortopts, self._longopts)
-        except (getopt.GetoptError, e):
-            self.fatal(e)
+        if args or self.optfunc:
+            import getopt
+            optfunc = self.optfunc or getopt.gnu_getopt
+            try:
+                (flags,extra) = optfunc(args, self._shortopts, self._longopts)
+            except getopt.GetoptError as e:
+                self.fatal(e)
+        else:
+            (flags,extra) = ([], [])  # nothing for getopt to do
 
         opt = OptDict()
 
@@ -0,0 +1,188 @@
+# ======================================================================
+# statcache.py
+# Share file stamps among the redo processes of one run
+# ======================================================================
+
+import os, errno, fcntl, mmap, struct
+import vars
+from helpers import close_on_exec
+
+# ----------------------------------------------------------------------
+# Private constants
+# ----------------------------------------------------------------------
+
+# The size of the cache file.  The file is sparse, so unused space costs
+# nothing; when it fills up, we just stop adding to it.
+CAPACITY = 64 * 1024 * 1024
+# The header: the number of bytes used, including the header
+HEADER = struct.Struct('<I')
+# A record: a stamp (three integers) and the length of the path that follows
+RECORD = struct.Struct('<qqqI')
+# The stamp of a record that says to forget the path
+FORGOTTEN = (-2, 0, 0)
+
+# ----------------------------------------------------------------------
+# Private variables
+# ----------------------------------------------------------------------
+
+# The cache file descriptor, or None if we haven't opened it yet
+_fd = None
+# The cache file, mapped into memory, or None if there isn't one
+_map = None
+# The number of bytes of _map we have read into _stamps
+_pos = HEADER.size
+# A map from path name to stamp
+_stamps = {}
+
+# ----------------------------------------------------------------------
+# Public functions
+# ----------------------------------------------------------------------
+
+def create():
+    '''
+    Create the cache file for the current run.  The process that starts
+    the run calls this; the file is removed when that process exits.
+    '''
+    path = _path()
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        os.ftruncate(fd, CAPACITY)
+        os.write(fd, HEADER.pack(HEADER.size))
+    finally:
+        os.close(fd)
+    import atexit
+    atexit.register(_remove, path, os.getpid())
+
+
+def get(path, statfunc):
+    '''
+    Get the stamp of a file
+    @param path The absolute path name of the file
+    @param statfunc The function that computes the stamp of a path
+    @return The stamp, from the cache if some process already computed it
+    during this run
+    '''
+    if not _open() or not _sync():
+        return statfunc(path)
+    stamp = _stamps.get(path)
+    if stamp == None:
+        since = _pos
+        stamp = statfunc(path)
+        _append(path, stamp, since)
+    return stamp
+
+
+def forget(path):
+    '''
+    Forget the stamp of a file, in every process, because it has just
+    been built.  We record that even if no process has shared a stamp for
+    it yet, because one may have read the old stamp and be about to.
+    @param path The absolute path name of the file
+    '''
+    if not _open() or not _sync():
+        return
+    _append(path, FORGOTTEN)
+
+# ----------------------------------------------------------------------
+# Private functions
+# ----------------------------------------------------------------------
+
+def _path():
+    return os.path.join(vars.BASE, '.redo', 'stat.%d' % vars.RUNID)
+
+
+def _remove(path, pid):
+    if os.getpid() != pid:
+        return  # a forked child exiting
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _open():
+    '''
+    Map the cache file for the current run, if there is one
+    @return Whether the cache is available
+    '''
+    global _fd, _map
+    if _fd != None:
+        return _map != None
+    _fd = -1
+    try:
+        fd = os.open(_path(), os.O_RDWR)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False  # the run was started without a stat cache
+        raise
+    close_on_exec(fd, True)
+    _fd = fd
+    _map = mmap.mmap(fd, CAPACITY, mmap.MAP_SHARED,
+                     mmap.PROT_READ | mmap.PROT_WRITE)
+    return True
+
+
+def _sync():
+    '''
+    Read the records that other processes have added since we last looked
+    @return Whether the cache is still usable
+    '''
+    global _pos, _map
+    end = HEADER.unpack_from(_map, 0)[0]
+    if end == 0:
+        # someone couldn't record a forget, so no stamp can be trusted
+        _map = None
+        _stamps.clear()
+        return False
+    for (stamp, b, _pos) in _records(_pos, end):
+        path = b.decode('utf-8', 'surrogateescape')
+        if stamp == FORGOTTEN:
+            _stamps.pop(path, None)
+        else:
+            _stamps[path] = stamp
+    return True
+
+
+def _records(pos, end):
+    '''
+    Read the records of the cache file between two positions
+    @return A generator of (stamp, encoded path, position of the next
+    record)
+    '''
+    while pos < end:
+        (mtime, size, ino, n) = RECORD.unpack_from(_map, pos)
+        start = pos + RECORD.size
+        pos = start + n
+        yield ((mtime, size, ino), _map[start:pos], pos)
+
+
+def _append(path, stamp, since=None):
+    '''
+    Add a record to the cache file
+    @param since For a stamp, the position in the file up to which we
+    had read the records when we read the stamp.  If a record to forget
+    the path has been added after that, the stamp may be older than the
+    file, so we don't add it.
+    '''
+    b = path.encode('utf-8', 'surrogateescape')
+    record = RECORD.pack(stamp[0], stamp[1], stamp[2], len(b)) + b
+    fcntl.lockf(_fd, fcntl.LOCK_EX, 0, 0)
+    try:
+        if not _sync():
+            return
+        if since != None:
+            for (old, name, next) in _records(since, _pos):
+                if old == FORGOTTEN and name == b:
+                    return
+        end = HEADER.unpack_from(_map, 0)[0]
+        if end + len(record) > CAPACITY:
+            if stamp == FORGOTTEN:
+                HEADER.pack_into(_map, 0, 0)
+                _sync()
+            return  # full; lookups still work, but nothing new is shared
+        _map[end:end+len(record)] = record
+        # readers trust the header, so update it last
+        HEADER.pack_into(_map, 0, end + len(record))
+        _sync()
+    finally:
+        fcntl.lockf(_fd, fcntl.LOCK_UN, 0, 0)
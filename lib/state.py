@@ -3,34 +3,74 @@
 # Redo build state
 # ====================================================================== 
 
-import sys, os, errno, glob, stat, fcntl, sqlite3
-import vars
-from helpers import remove, close_on_exec, join
-from log import warn, err, debug2, debug3
+import sys, os, errno, stat, fcntl, sqlite3, time
+import vars, statcache, graph
+from helpers import remove, close_on_exec, join, file_digest
+from log import warn, err, debug, debug2, debug3
 
 # ----------------------------------------------------------------------
 # Private constants
 # ----------------------------------------------------------------------
 
-SCHEMA_VER=1
+SCHEMA_VER=7
 TIMEOUT=60
+MAX_VARS=500    # the most host parameters we bind to one statement
+SET_SPLIT=16    # the average number of dependences in a shared set
 
-ALWAYS='//ALWAYS'   # an invalid filename that is always marked as dirty
-STAMP_DIR='dir'     # the stamp of a directory; mtime is unhelpful
-STAMP_MISSING='0'   # the stamp of a nonexistent file
+ALWAYS='//ALWAYS'       # an invalid filename that is always marked as dirty
+STAMP_DIR=(-1, 0, 0)    # the stamp of a directory; mtime is unhelpful
+STAMP_MISSING=(0, 0, 0) # the stamp of a nonexistent file
 
 # ----------------------------------------------------------------------
 # Private variables
 # ----------------------------------------------------------------------
 
 _db = None
+# Writes queued by _write and not yet executed, as (query, args) pairs
+_pending = []
+# The number of writes executed but not yet committed
 _wrote = 0
+# The time of the last commit
+_last_commit = 0
 _insane = None
 _cwd = None
 _file_cols = ['rowid', 'name', 'is_generated', 'is_override',
               'checked_runid', 'changed_runid', 'failed_runid',
-              'stamp', 'csum']
+              'mtime_ns', 'size', 'inode', 'csum', 'digest', 'cutoff_runid',
+              'duration_ms', 'depsets']
 _locks = {}
+# The descriptor of .redo/locks, or None if we haven't opened it yet.  We
+# never close it: closing any descriptor of the file would release all of
+# this process's locks in it.
+_lockfd = None
+# A map from file id to the last Files row we read or wrote for it
+_cache = {}
+# A map from file name to file id, for the files in _cache
+_cache_ids = {}
+# The data_version of the database when _cache was last known to be valid
+_cache_version = None
+# Ids of files checked in this run whose checked_runid is not yet written;
+# commit() writes them all at once
+_checked = set()
+# The snapshot of the graph (see graph.py), if vars.GRAPH is set and we
+# have loaded it
+_graph = None
+# Ids of files whose rows or dependences may have changed since _graph
+# was loaded; we read those from the database
+_graph_stale = set()
+# A map from absolute path name to stamp, for the files stat'ed in advance
+# by prefetch_stamps; empty except while deps.isdirty runs
+_prefetched = {}
+# While a check holds them (see hold_rows), the ids of the files whose
+# rows we have read from the database during it; otherwise None
+_held = None
+# A map from the id of a shared set of dependences to its members, as a
+# tuple of (mode, source id).  A set never changes once stored, so we
+# never need to forget one.
+_sets = {}
+# A map from the digest of a set's members to its id, for the sets in _sets
+# that we have stored or looked up
+_set_ids = {}
 
 # ----------------------------------------------------------------------
 # Public classes
@@ -38,39 +78,53 @@ _locks = {}
 
 class File(object):
     # use this mostly to avoid accidentally assigning to typos
-    __slots__ = ['id'] + _file_cols[1:]
+    __slots__ = ['id', 'name', 'is_generated', 'is_override',
+                 'checked_runid', 'changed_runid', 'failed_runid',
+                 'stamp', 'csum', 'digest', 'cutoff_runid', 'duration_ms',
+                 'depsets', '_saved']
 
-    def _init_from_idname(self, id, name):
-        q = ('select %s from Files ' % join(', ', _file_cols))
+    def _init_from_idname(self, id, name, cached=True):
         if id != None:
-            q += 'where rowid=?'
+            where = 'rowid=?'
             l = [id]
         elif name != None:
-            name = (name==ALWAYS) and ALWAYS or relpath(name, vars.BASE)
-            q += 'where name=?'
+            name = _normname(name)
+            where = 'name=?'
             l = [name]
+            id = _cache_ids.get(name)
         else:
             raise Exception('name or id must be set')
-        d = db()
-        row = d.execute(q, l).fetchone()
+        row = cached and (_cache.get(id) or _graph_row(id, name))
+        if row:
+            return self._init_from_cols(row)
+        q = ('select %s from Files where %s' % (join(', ', _file_cols), where))
+        row = _read(q, l).fetchone()
         if not row:
             if not name:
                 raise Exception('File with id=%r not found and '
                                 'name not given' % id)
-            try:
-                _write('insert into Files (name) values (?)', [name])
-            except sqlite3.IntegrityError:
-                # some parallel redo probably added it at the same time; no
-                # big deal.
-                pass
-            row = d.execute(q, l).fetchone()
+            # some parallel redo may add it at the same time; no big deal.
+            _write('insert or ignore into Files (name) values (?)', [name])
+            row = _read(q, l).fetchone()
             assert(row)
         return self._init_from_cols(row)
 
     def _init_from_cols(self, cols):
         (self.id, self.name, self.is_generated, self.is_override,
          self.checked_runid, self.changed_runid, self.failed_runid,
-         self.stamp, self.csum) = cols
+         mtime_ns, size, inode, self.csum, self.digest,
+         self.cutoff_runid, self.duration_ms, self.depsets) = cols
+        if mtime_ns == None:
+            self.stamp = None
+        else:
+            self.stamp = (mtime_ns, size, inode)
+        # the row as stored (plus deferred checks), so save() can tell if
+        # anything changed
+        self._saved = tuple(cols)
+        if self.id in _checked:
+            self.checked_runid = vars.RUNID
+            self._saved = self._saved[:4] + (vars.RUNID,) + self._saved[5:]
+        _cache_put(self._saved)
         if self.name == ALWAYS and self.changed_runid != None and self.changed_runid < vars.RUNID:
             self.changed_runid = vars.RUNID
     
@@ -80,25 +134,66 @@ class File(object):
         else:
             return self._init_from_idname(id, name)
 
+    @classmethod
+    def bulk(cls, names):
+        '''
+        Look up many files by name at once, creating the missing ones
+        @param names The file names
+        @return A list of Files, in the same order as names
+        '''
+        names = [_normname(name) for name in names]
+        rows = {}
+        for name in names:
+            row = _cache.get(_cache_ids.get(name)) or _graph_row(None, name)
+            if row:
+                rows[name] = row
+        rows.update(_rows_by_name([name for name in names
+                                   if name not in rows]))
+        missing = [name for name in set(names) if name not in rows]
+        if missing:
+            # some parallel redo may add them at the same time; no big deal.
+            for name in missing:
+                _write('insert or ignore into Files (name) values (?)',
+                       [name])
+            rows.update(_rows_by_name(missing))
+        return [cls(cols=rows[name]) for name in names]
+
     def refresh(self):
-        self._init_from_idname(self.id, None)
+        self._init_from_idname(self.id, None, cached=False)
+
+    def _row(self):
+        return ((self.id, self.name, self.is_generated, self.is_override,
+                 self.checked_runid, self.changed_runid, self.failed_runid) +
+                tuple(self.stamp or (None, None, None)) +
+                (self.csum, self.digest, self.cutoff_runid, self.duration_ms,
+                 self.depsets))
 
     def save(self):
-        cols = join(', ', ['%s=?'%i for i in _file_cols[2:]])
+        row = self._row()
+        if row == self._saved:
+            return  # nothing to write
+        # only zap_deps1 and zap_deps2 write depsets, so a process holding
+        # an old row can't undo them
+        cols = join(', ', ['%s=?'%i for i in _file_cols[2:-1]])
         _write('update Files set '
                '    %s '
                '    where rowid=?' % cols,
-               [self.is_generated, self.is_override,
-                self.checked_runid, self.changed_runid, self.failed_runid,
-                self.stamp, self.csum,
-                self.id])
+               list(row[2:-1]) + [self.id])
+        self._saved = row[:-1] + self._saved[-1:]
+        _cache_put(self._saved)
 
     def set_checked(self):
         self.checked_runid = vars.RUNID
 
     def set_checked_save(self):
         self.set_checked()
-        self.save()
+        row = self._row()
+        if row[:4] + row[5:] != self._saved[:4] + self._saved[5:]:
+            return self.save()
+        # only checked_runid changed: defer the write until commit()
+        _checked.add(self.id)
+        self._saved = row
+        _cache_put(row)
 
     def set_changed(self):
         debug2('BUILT: %r (%r)\n' % (self.name, self.stamp))
@@ -106,6 +201,26 @@ class File(object):
         self.failed_runid = None
         self.is_override = False
 
+    def set_csum(self, csum):
+        '''
+        Record a checksum of the file's contents.  The file counts as
+        changed only if the checksum differs from the last one; otherwise
+        it counts as checked.
+        @param csum The checksum, or None if there is nothing to checksum
+        @return Whether the file changed
+        '''
+        changed = (csum == None or csum != self.csum)
+        debug2('%s: old = %s\n' % (self.name, self.csum))
+        debug2('%s: sum = %s (%s)\n' % (self.name, csum,
+                                        changed and 'changed' or 'unchanged'))
+        self.failed_runid = None
+        if changed:
+            self.set_changed()  # update_stamp might not do this if the mtime is identical
+            self.csum = csum
+        else:
+            self.set_checked()
+        return changed
+
     def set_failed(self):
         debug2('FAILED: %r\n' % self.name)
         self.update_stamp()
@@ -113,9 +228,16 @@ class File(object):
         self.is_generated = True
 
     def set_static(self):
-        self.update_stamp(must_exist=True)
+        newstamp = self.read_stamp()
+        if newstamp != self.stamp and self.same_content(newstamp):
+            debug2("STAMP: %s: %r -> %r (same content)\n"
+                   % (self.name, self.stamp, newstamp))
+            self.stamp = newstamp
+        else:
+            self.update_stamp(must_exist=True)
         self.is_override = False
         self.is_generated = False
+        self.update_digest()
 
     def set_override(self):
         self.update_stamp()
@@ -128,6 +250,7 @@ class File(object):
         if newstamp != self.stamp:
             debug2("STAMP: %s: %r -> %r\n" % (self.name, self.stamp, newstamp))
             self.stamp = newstamp
+            self.digest = None  # no longer describes the file
             self.set_changed()
 
     def is_checked(self):
@@ -136,54 +259,179 @@ class File(object):
     def is_changed(self):
         return self.changed_runid and self.changed_runid >= vars.RUNID
 
+    def is_cutoff(self):
+        return self.cutoff_runid and self.cutoff_runid >= vars.RUNID
+
     def is_failed(self):
         return self.failed_runid and self.failed_runid >= vars.RUNID
 
     def deps(self):
+        for (key, deps) in self.dep_sets():
+            for (mode, f) in deps:
+                yield mode,f
+
+    def dep_sets(self):
+        '''
+        @return The file's dependences, as a list of (key, deps), where
+        deps is a list of (mode, File): the id and members of each shared
+        set the file refers to, or, while the file is being built, None
+        and its own dependences
+        '''
+        if self.depsets == None:
+            return [(None, list(self._own_deps()))]
+        # with vars.GRAPH, the snapshot holds the sets' members and rows
+        _graph_load()
+        sets = _set_list(self.depsets)
+        members = _set_members(sets)
+        files = _files_by_id([source for id in sets
+                              for (mode, source) in members.get(id, ())])
+        return [(id, [(mode, files[source])
+                      for (mode, source) in members.get(id, ())
+                      if source in files])
+                for id in sets]
+
+    def _own_deps(self):
+        g = _graph_load()
+        if g and self.id not in _graph_stale:
+            for (mode, id) in g.deps(self.id):
+                yield mode,File(id=id)
+            return
         q = ('select Deps.mode, Deps.source, %s '
              '  from Files '
              '    join Deps on Files.rowid = Deps.source '
              '  where target=?' % join(', ', _file_cols[1:]))
-        for row in db().execute(q, [self.id]).fetchall():
+        for row in _read(q, [self.id]).fetchall():
             mode = row[0]
             cols = row[1:]
-            assert(mode in ('c', 'm'))
+            assert(mode in ('c', 'd', 'm'))
             yield mode,File(cols=cols)
 
     def zap_deps1(self):
         debug2('zap-deps1: %r\n' % self.name)
+        _graph_stale.add(self.id)
         _write('update Deps set delete_me=? where target=?', [True, self.id])
+        self._unshare(True)
 
     def zap_deps2(self):
         debug2('zap-deps2: %r\n' % self.name)
+        _graph_stale.add(self.id)
+        self._unshare(False)
         _write('delete from Deps where target=? and delete_me=1', [self.id])
+        rows = _read('select mode, source from Deps where target=?',
+                     [self.id]).fetchall()
+        _write('delete from Deps where target=?', [self.id])
+        self._set_depsets(_intern(rows))
+
+    def _unshare(self, delete_me):
+        '''
+        Turn the shared sets the file refers to back into Deps rows of its
+        own, which a build can add to and delete from
+        @param delete_me Whether the build must add each one again to keep it
+        '''
+        if self.depsets == None:
+            return
+        sets = _set_list(self.depsets)
+        members = _set_members(sets)
+        for id in sets:
+            for (mode, source) in members.get(id, ()):
+                _write("insert or ignore into Deps "
+                       "    (target, mode, source, delete_me) "
+                       "    values (?,?,?,?)",
+                       [self.id, mode, source, delete_me])
+        self._set_depsets(None)
+
+    def _set_depsets(self, depsets):
+        self.depsets = depsets
+        _write('update Files set depsets=? where rowid=?',
+               [depsets, self.id])
+        self._saved = self._saved[:-1] + (depsets,)
+        _cache_put(self._saved)
 
     def add_dep(self, mode, dep):
-        src = File(name=dep)
-        debug3('add-dep: "%s" < %s "%s"\n' % (self.name, mode, src.name))
-        assert(self.id != src.id)
-        _write("insert or replace into Deps "
-               "    (target, mode, source, delete_me) values (?,?,?,?)",
-               [self.id, mode, src.id, False])
+        self.add_deps(mode, [dep])
+
+    def add_deps(self, mode, deps):
+        _graph_stale.add(self.id)
+        for src in File.bulk(deps):
+            debug3('add-dep: "%s" < %s "%s"\n' % (self.name, mode, src.name))
+            assert(self.id != src.id)
+            _write("insert or replace into Deps "
+                   "    (target, mode, source, delete_me) values (?,?,?,?)",
+                   [self.id, mode, src.id, False])
 
     def read_stamp(self):
+        path = os.path.join(vars.BASE, self.name)
+        if vars.STAT_CACHE:
+            return statcache.get(path, _prefetched_stamp)
+        return _prefetched_stamp(path)
+
+    def exists(self):
+        '''
+        @return Whether the file exists; unlike read_stamp, this never
+        goes through the stat cache, which only holds the files redo
+        has looked at as dependences
+        '''
+        path = os.path.join(vars.BASE, self.name)
+        stamp = _prefetched.get(path)
+        if stamp != None:
+            return stamp != STAMP_MISSING
+        return os.path.exists(path)
+
+    def forget_stamp(self):
+        '''
+        Make every process of this run stat the file again, because it has
+        just been built
+        '''
+        if vars.STAT_CACHE:
+            statcache.forget(os.path.join(vars.BASE, self.name))
+
+    def read_digest(self):
+        '''
+        @return The digest of the file's contents, or None if it isn't
+        a regular file we can read
+        '''
         try:
-            st = os.stat(os.path.join(vars.BASE, self.name))
-        except OSError:
-            return STAMP_MISSING
-        if stat.S_ISDIR(st.st_mode):
-            return STAMP_DIR
-        else:
-            # a "unique identifier" stamp for a regular file
-            return str((st.st_mtime, st.st_size, st.st_ino))
+            return file_digest(os.path.join(vars.BASE, self.name),
+                               vars.CSUM_ALGO)
+        except (IOError, OSError):
+            return None
+
+    def update_digest(self):
+        '''
+        Record the digest of a source file, if content stamps are on and
+        we don't have it yet
+        '''
+        if (vars.CONTENT_STAMPS and self.digest == None
+            and not self.is_generated
+            and self.stamp not in (None, STAMP_MISSING, STAMP_DIR)):
+            self.digest = self.read_digest()
+
+    def same_content(self, newstamp):
+        '''
+        Determine whether a static file whose stamp changed still has the
+        contents we recorded.  This only hashes the file when content
+        stamps are on and we have a digest to compare with.
+        @param newstamp The file's current stamp
+        @return True if the contents are known to be unchanged
+        '''
+        if (not vars.CONTENT_STAMPS or self.is_generated or not self.digest
+            or newstamp in (STAMP_MISSING, STAMP_DIR)):
+            return False
+        return self.read_digest() == self.digest
 
     def nicename(self):
         return relpath(os.path.join(vars.BASE, self.name), vars.STARTDIR)
 
 
 def files():
+    # one scan of Files is as fast as loading the graph, so only use the
+    # snapshot if it's already there
+    if _graph and not _graph_stale:
+        for name in sorted(_graph.ids):
+            yield File(id=_graph.ids[name])
+        return
     q = ('select %s from Files order by name' % join(', ', _file_cols))
-    for cols in db().execute(q).fetchall():
+    for cols in _read(q).fetchall():
         yield File(cols=cols)
 
 
@@ -193,12 +441,14 @@ def files():
 # ok, but it doesn't have F_GETLK, so we can't report which pid owns the lock.
 # The makes debugging a bit harder.  When we someday port to C, we can do that.
 class Lock:
+    '''
+    A lock on a target, so only one redo builds it at a time.  The lock
+    is the byte at offset fid in .redo/locks.
+    '''
     def __init__(self, fid):
         self.owned = False
         self.fid = fid
-        self.lockfile = os.open(os.path.join(vars.BASE, '.redo/lock.%d' % fid),
-                                os.O_RDWR | os.O_CREAT, 0o666)
-        close_on_exec(self.lockfile, True)
+        self.lockfile = _lockfile()
         assert(_locks.get(fid,0) == 0)
         _locks[fid] = 1
 
@@ -206,12 +456,12 @@ class Lock:
         _locks[self.fid] = 0
         if self.owned:
             self.unlock()
-        os.close(self.lockfile)
     
     def trylock(self):
         assert(not self.owned)
         try:
-            fcntl.lockf(self.lockfile, fcntl.LOCK_EX|fcntl.LOCK_NB, 0, 0)
+            fcntl.lockf(self.lockfile, fcntl.LOCK_EX|fcntl.LOCK_NB,
+                        1, self.fid)
         except IOError as e:
             if e.errno in (errno.EAGAIN, errno.EACCES):
                 pass  # someone else has it locked
@@ -219,17 +469,20 @@ class Lock:
                 raise
         else:
             self.owned = True
+            # whoever held the lock may have just updated the target
+            _cache_drop(self.fid)
 
     def waitlock(self):
         assert(not self.owned)
-        fcntl.lockf(self.lockfile, fcntl.LOCK_EX, 0, 0)
+        fcntl.lockf(self.lockfile, fcntl.LOCK_EX, 1, self.fid)
         self.owned = True
+        _cache_drop(self.fid)
             
     def unlock(self):
         if not self.owned:
             raise Exception("can't unlock %r - we don't own it" 
-                            % self.lockname)
-        fcntl.lockf(self.lockfile, fcntl.LOCK_UN, 0, 0)
+                            % self.fid)
+        fcntl.lockf(self.lockfile, fcntl.LOCK_UN, 1, self.fid)
         self.owned = False
 
         
@@ -241,13 +494,30 @@ def init():
     db()
 
 
-def commit():
+def commit(lazy=False):
+    '''
+    Commit the queued writes
+    @param lazy Whether the commit may be coalesced with a later one.
+           A lazy commit within vars.COMMIT_WINDOW milliseconds of the
+           previous commit leaves the writes queued, unless they have
+           already been executed (and so hold the database write lock);
+           it still checks whether the cached rows are stale.
+    '''
     if _insane:
         return
-    global _wrote
+    global _wrote, _last_commit
+    now = time.time()
+    if (lazy and not _wrote and
+        now - _last_commit < vars.COMMIT_WINDOW / 1000.0):
+        _cache_check()
+        return
+    _write_checked()
+    _flush()
     if _wrote:
         db().commit()
         _wrote = 0
+    _last_commit = now
+    _cache_check()
 
 def check_sane():
     global _insane, _writable
@@ -264,15 +534,12 @@ def relpath(t, base):
     base = os.path.normpath(base)
     tparts = t.split('/')
     bparts = base.split('/')
-    for tp,bp in list(zip(tparts,bparts)):
+    common = 0
+    for tp,bp in zip(tparts,bparts):
         if tp != bp:
             break
-        tparts.pop(0)
-        bparts.pop(0)
-    while bparts:
-        tparts.insert(0, '..')
-        bparts.pop(0)
-    result = join('/', tparts)
+        common += 1
+    result = join('/', ['..'] * (len(bparts) - common) + tparts[common:])
     return result
 
 
@@ -280,14 +547,214 @@ def warn_override(name):
     warn('%s - you modified it; skipping\n' % name)
 
 
+def read_stamps(names, threads=0):
+    '''
+    Stat files, on a pool of threads if threads is more than 0.  On a
+    high-latency filesystem, that bounds the time by the filesystem's
+    throughput rather than by its round trips.
+    @param names The file names, relative to the base
+    @param threads The number of threads
+    @return A map from each name to its stamp
+    '''
+    if threads <= 0:
+        return dict(_read_stamps(names))
+    from concurrent.futures import ThreadPoolExecutor
+    # one slice per thread, since a task per file costs more than its stat;
+    # os.stat releases the interpreter lock, so the slices really overlap
+    slices = [names[i::threads] for i in range(threads)]
+    stamps = {}
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for pairs in pool.map(_read_stamps, slices):
+            stamps.update(pairs)
+    return stamps
+
+
+def prefetch_stamps(names, threads):
+    '''
+    Stat files with read_stamps, so that File.read_stamp and File.exists
+    find the results instead of waiting for each stat in turn.  The
+    results are kept until clear_stamps.
+    @param names The file names, relative to the base
+    @param threads The number of threads
+    '''
+    names = [name for name in set(names)
+             if os.path.join(vars.BASE, name) not in _prefetched]
+    if not names:
+        return
+    start = time.time()
+    for (name, stamp) in read_stamps(names, threads).items():
+        _prefetched[os.path.join(vars.BASE, name)] = stamp
+    debug('prefetch: %d files on %d threads in %.3fs\n'
+          % (len(names), threads, time.time() - start))
+
+
+def clear_stamps():
+    '''
+    Forget the stamps from prefetch_stamps
+    '''
+    _prefetched.clear()
+
+
+def hold_rows():
+    '''
+    Read each file's row from the database at most once until
+    release_rows, instead of once for each set of dependences it is in
+    (see _files_by_id).  isdirty holds the rows while it checks a
+    target.
+    '''
+    global _held
+    _held = set()
+
+
+def release_rows():
+    '''
+    Read rows not in the graph snapshot afresh each time again
+    '''
+    global _held
+    _held = None
+
+
+def closure(targets):
+    '''
+    Find everything some targets depend on, directly or not, with one
+    scan of Deps and one of Files, plus a read of the shared sets
+    @param targets A list of Files
+    @return A list of (mode, File, target): the targets and the files
+    they depend on through 'm' dependences, as 'm'; the files whose
+    creation would make one of those dirty, as 'c'; and the directories
+    where a .do file for one of those would make it dirty, as 'd'.
+    target is the File that depends on the file (for the targets
+    themselves, None); for 'c' and 'm', which one is arbitrary.
+    '''
+    sources = {}
+    for (target, source, mode) in _read('select target, source, mode '
+                                        '  from Deps').fetchall():
+        sources.setdefault(target, []).append((mode, source))
+    rows = dict([(cols[0], cols) for cols in
+                 _read('select %s from Files' % join(', ', _file_cols))])
+    members = _set_members([id for cols in rows.values()
+                            for id in _set_list(cols[-1])])
+    for (target, cols) in rows.items():
+        for id in _set_list(cols[-1]):
+            sources.setdefault(target, []).extend(members.get(id, ()))
+    found = dict([(('m', f.id), None) for f in targets])
+    stack = [f.id for f in targets]
+    while stack:
+        target = stack.pop()
+        for (mode, source) in sources.get(target, []):
+            # a directory matters once for each target that looked in it
+            key = (mode == 'd') and (mode, source, target) or (mode, source)
+            if key not in found:
+                found[key] = target
+                if mode == 'm':
+                    stack.append(source)
+    ids = set([key[1] for key in found]) | set(found.values())
+    files = {}
+    for id in ids:
+        if id in rows:
+            files[id] = File(cols=rows[id])
+    return [(key[0], files[key[1]], files.get(target))
+            for (key, target) in found.items() if key[1] in files]
+
+
+def last_runids():
+    '''
+    @return The highest changed, checked and failed run ids of any file.
+    Building or checking anything raises at least one of them, so if
+    they are the same as before, no file's state has changed.
+    '''
+    return tuple(_read('select max(changed_runid), max(checked_runid), '
+                       '       max(failed_runid) from Files').fetchone())
+
+
+def do_listing(dir):
+    '''
+    @param dir The absolute path of a directory
+    @return The last listing of the .do files in dir, as (mtime_ns, set
+    of names), or None
+    '''
+    row = _read('select mtime_ns, names from DoFiles where dir=?',
+                [_normname(dir)]).fetchone()
+    if not row:
+        return None
+    return (row[0], frozenset([name for name in row[1].split('/') if name]))
+
+
+def set_do_listing(dir, mtime_ns, names):
+    '''
+    Record a listing of the .do files in a directory
+    @param dir The absolute path of the directory
+    @param mtime_ns The directory's mtime when it was listed
+    @param names The names of the .do files in it
+    '''
+    _write('insert or replace into DoFiles (dir, mtime_ns, names) '
+           '  values (?,?,?)', [_normname(dir), mtime_ns,
+                                join('/', sorted(names))])
+
+
+def gc():
+    '''
+    Delete the state that no build can use any more: the records of
+    files that don't exist and that nothing depends on (along with their
+    own dependencies, which may orphan more files), dependencies on
+    records that don't exist, shared sets of dependencies that no file
+    refers to, listings of directories that don't exist, old run ids,
+    and leftover lock and stat cache files.  Then compact the database.
+    @return (files, deps, runids, paths): the number of each removed,
+    or None if some target is locked, i.e., a build is running
+    '''
+    global _graph
+    commit()
+    fd = _lockfile()
+    try:
+        # a lock on the whole file conflicts with every target's lock
+        fcntl.lockf(fd, fcntl.LOCK_EX|fcntl.LOCK_NB, 0, 0)
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    try:
+        d = db()
+        d.execute('begin exclusive')
+        try:
+            (files, deps, runids) = _gc_rows(d)
+        except:
+            d.rollback()
+            raise
+        d.commit()
+        _cache.clear()
+        _cache_ids.clear()
+        _sets.clear()
+        _set_ids.clear()
+        _graph = None
+        paths = _gc_paths()
+        # keep the journal from holding on to the space vacuum frees
+        d.execute('pragma journal_size_limit = 0')
+        d.execute('vacuum')
+        if d.execute('pragma journal_mode').fetchone()[0] == 'wal':
+            d.execute('pragma wal_checkpoint(truncate)')
+    finally:
+        fcntl.lockf(fd, fcntl.LOCK_UN, 0, 0)
+    return (files, deps, runids, paths)
+
+
 # ----------------------------------------------------------------------
 # Private functions
 # ----------------------------------------------------------------------
 
 def _connect(dbfile):
     _db = sqlite3.connect(dbfile, timeout=TIMEOUT)
-    _db.execute("pragma synchronous = off")
-    _db.execute("pragma journal_mode = PERSIST")
+    mode = _db.execute("pragma journal_mode").fetchone()[0]
+    if vars.WAL or mode == 'wal':
+        # Once a database is in WAL mode, it stays that way: switching back
+        # would need exclusive access, which other redo processes may
+        # prevent.  In WAL mode, readers don't block writers, and
+        # synchronous=normal is enough to survive a crash.
+        _db.execute("pragma journal_mode = WAL")
+        _db.execute("pragma synchronous = normal")
+    else:
+        _db.execute("pragma synchronous = off")
+        _db.execute("pragma journal_mode = PERSIST")
     _db.text_factory = str
     return _db
 
@@ -315,6 +782,8 @@ def db():
         except sqlite3.OperationalError:
             row = None
         ver = row and row[0] or None
+        if ver != SCHEMA_VER and ver in _migrations:
+            ver = _migrate(_db)
         if ver != SCHEMA_VER:
             err("state database: discarding v%s (wanted v%s)\n"
                 % (ver, SCHEMA_VER))
@@ -327,21 +796,16 @@ def db():
                     "    (version int)")
         _db.execute("create table Runid "
                     "    (id integer primary key autoincrement)")
-        _db.execute("create table Files "
-                    "    (name not null primary key, "
-                    "     is_generated int, "
-                    "     is_override int, "
-                    "     checked_runid int, "
-                    "     changed_runid int, "
-                    "     failed_runid int, "
-                    "     stamp, "
-                    "     csum)")
+        _create_files(_db)
         _db.execute("create table Deps "
                     "    (target int, "
                     "     source int, "
                     "     mode not null, "
                     "     delete_me int, "
                     "     primary key (target,source))")
+        _db.execute("create index DepsSource on Deps (source)")
+        _create_dofiles(_db)
+        _create_depsets(_db)
         _db.execute("insert into Schema (version) values (?)", [SCHEMA_VER])
         # eat the '0' runid and File id
         _db.execute("insert into Runid values "
@@ -353,16 +817,586 @@ def db():
                     "     ((select max(id)+1 from Runid))")
         vars.RUNID = _db.execute("select last_insert_rowid()").fetchone()[0]
         os.environ['REDO_RUNID'] = str(vars.RUNID)
+        if vars.STAT_CACHE:
+            statcache.create()
     
     _db.commit()
     return _db
     
 
+def _lockfile():
+    '''
+    @return The descriptor of .redo/locks, opening it the first time
+    '''
+    global _lockfd
+    if _lockfd == None:
+        _lockfd = os.open(os.path.join(vars.BASE, '.redo/locks'),
+                          os.O_RDWR | os.O_CREAT, 0o666)
+        close_on_exec(_lockfd, True)
+    return _lockfd
+
+
+def _gc_rows(d):
+    '''
+    Delete the database rows for gc()
+    @param d The database connection, in a transaction
+    @return (files, deps, runids): the number of each deleted
+    '''
+    deps = d.execute('delete from Deps '
+                     '  where target not in (select rowid from Files) '
+                     '     or source not in (select rowid from Files)'
+                     ).rowcount
+    files = 0
+    present = set()  # ids of files we know exist
+    q = ('select rowid, name, is_generated, mtime_ns, size, inode from Files '
+         '  where rowid not in (select source from Deps) '
+         '    and rowid not in (select source from DepSetMembers) '
+         '    and name != ?')
+    while True:
+        deps += _gc_sets(d)
+        gone = []
+        for (id, name, is_generated, mtime_ns, size, inode) in \
+                d.execute(q, [ALWAYS]).fetchall():
+            if id in present:
+                pass
+            elif (is_generated and
+                  (mtime_ns, size, inode) == STAMP_MISSING):
+                # a target that is up to date without producing a file
+                present.add(id)
+            elif _read_stamp(os.path.join(vars.BASE, name)) == STAMP_MISSING:
+                gone.append(id)
+            else:
+                present.add(id)
+        if not gone:
+            break
+        for i in range(0, len(gone), MAX_VARS):
+            ids = gone[i:i+MAX_VARS]
+            marks = join(', ', ['?'] * len(ids))
+            deps += d.execute('delete from Deps where target in (%s)' % marks,
+                              ids).rowcount
+            files += d.execute('delete from Files where rowid in (%s)' % marks,
+                               ids).rowcount
+    listings = [[dir] for (dir,) in d.execute('select dir from DoFiles')
+                if not os.path.isdir(os.path.join(vars.BASE, dir))]
+    d.executemany('delete from DoFiles where dir=?', listings)
+    runids = d.execute('delete from Runid '
+                       '  where id < (select max(id) from Runid)').rowcount
+    return (files, deps, runids)
+
+
+def _gc_sets(d):
+    '''
+    Delete the shared sets of dependences that no file refers to
+    @param d The database connection, in a transaction
+    @return The number of dependences deleted with them
+    '''
+    used = set()
+    for (depsets,) in d.execute('select depsets from Files'):
+        used.update(_set_list(depsets))
+    gone = [[id] for (id,) in d.execute('select id from DepSets').fetchall()
+            if id not in used]
+    n = d.executemany('delete from DepSetMembers where depset=?',
+                      gone).rowcount
+    d.executemany('delete from DepSets where id=?', gone)
+    return max(n, 0)
+
+
+def _gc_paths():
+    '''
+    Delete the files in .redo for gc(): per-target lock files from before
+    .redo/locks, and the stat caches of runs that died
+    @return The number of files deleted
+    '''
+    import glob
+    n = 0
+    mine = os.path.join(vars.BASE, '.redo', 'stat.%d' % vars.RUNID)
+    for path in (glob.glob(os.path.join(vars.BASE, '.redo', 'lock.*')) +
+                 glob.glob(os.path.join(vars.BASE, '.redo', 'stat.*'))):
+        if path == mine:
+            continue
+        try:
+            os.unlink(path)
+            n += 1
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return n
+
+
+def _read_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return STAMP_MISSING
+    if stat.S_ISDIR(st.st_mode):
+        return STAMP_DIR
+    else:
+        # a "unique identifier" stamp for a regular file
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _read_stamps(names):
+    return [(name, _read_stamp(os.path.join(vars.BASE, name)))
+            for name in names]
+
+
+def _prefetched_stamp(path):
+    stamp = _prefetched.get(path)
+    if stamp == None:
+        stamp = _read_stamp(path)
+    return stamp
+
+
+def _write_checked():
+    '''
+    Queue the writes of the deferred checked_runids
+    '''
+    ids = list(_checked)
+    _checked.clear()
+    for i in range(0, len(ids), MAX_VARS):
+        chunk = ids[i:i+MAX_VARS]
+        _write('update Files set checked_runid=? where rowid in (%s)'
+               % join(', ', ['?']*len(chunk)), [vars.RUNID] + chunk)
+
+
+def _cache_put(row):
+    _cache[row[0]] = row
+    _cache_ids[row[1]] = row[0]
+
+
+def _cache_drop(id):
+    _graph_stale.add(id)
+    row = _cache.pop(id, None)
+    if row:
+        del _cache_ids[row[1]]
+
+
+def _cache_check():
+    '''
+    Forget the cached rows if another process has committed changes to the
+    database since we last checked
+    '''
+    global _cache_version, _graph
+    if _insane:
+        return
+    version = db().execute("pragma data_version").fetchone()[0]
+    if version != _cache_version:
+        debug3('cache: dropping %d rows\n' % len(_cache))
+        _cache.clear()
+        _cache_ids.clear()
+        _cache_version = version
+    if _graph and version != _graph.version:
+        debug3('graph: dropping the snapshot\n')
+        _graph = None
+
+
+def _graph_load():
+    '''
+    Load the snapshot of the graph, if vars.GRAPH is set and we haven't
+    already
+    @return The snapshot, or None
+    '''
+    global _graph
+    if not vars.GRAPH or _insane:
+        return None
+    if _graph == None:
+        start = time.time()
+        _flush()
+        d = db()
+        # read both tables in one transaction, so they agree
+        begun = not d.in_transaction
+        if begun:
+            d.execute('begin')
+        try:
+            version = d.execute("pragma data_version").fetchone()[0]
+            files = d.execute('select %s from Files'
+                              % join(', ', _file_cols)).fetchall()
+            deps = d.execute('select target, source, mode from Deps '
+                             '  order by target').fetchall()
+            members = d.execute('select depset, mode, source '
+                                '  from DepSetMembers').fetchall()
+        finally:
+            if begun:
+                d.commit()
+        _graph = graph.Graph(files, deps, _file_cols, version)
+        _graph_stale.clear()
+        _set_put(members)
+        debug('graph: %d files, %d dependences, %d shared, %d KB, '
+              'loaded in %.3fs\n'
+              % (_graph.nfiles, _graph.ndeps, len(members),
+                 _graph.size() / 1024, time.time() - start))
+    return _graph
+
+
+def _graph_row(id, name):
+    '''
+    @param id The file's id, or None to look it up by name
+    @param name The file's normalized name
+    @return The row of a file from the graph snapshot, if we have loaded
+    one and the row can't be stale; else None
+    '''
+    if not _graph:
+        return None
+    if id == None:
+        id = _graph.ids.get(name)
+    if id == None or id in _graph_stale:
+        return None
+    return _graph.row(id)
+
+
+def _normname(name):
+    '''
+    @return The name of a file as stored in the database
+    '''
+    return (name==ALWAYS) and ALWAYS or relpath(name, vars.BASE)
+
+
+def _rows_by_name(names):
+    '''
+    @param names Normalized file names
+    @return A map from name to Files row, for the names that have rows
+    '''
+    q = ('select %s from Files where name in (%%s)' % join(', ', _file_cols))
+    names = list(set(names))
+    rows = {}
+    for i in range(0, len(names), MAX_VARS):
+        chunk = names[i:i+MAX_VARS]
+        for row in _read(q % join(', ', ['?']*len(chunk)), chunk):
+            rows[row[1]] = row
+    return rows
+
+
+def _files_by_id(ids):
+    '''
+    @param ids File ids
+    @return A map from id to File, for the ids that have rows.  Rows not
+    in the graph snapshot are read again, not taken from _cache: another
+    process may have rebuilt the files since we cached them, and we may
+    not have committed since.  Reading them refreshes _cache.  While
+    the rows are held (see hold_rows), a row read once is taken from
+    _cache after that.
+    '''
+    files = {}
+    missing = []
+    for id in set(ids):
+        row = _graph_row(id, None)
+        if not row and _held != None and id in _held:
+            row = _cache.get(id)
+        if row:
+            files[id] = File(cols=row)
+        else:
+            missing.append(id)
+    q = ('select %s from Files where rowid in (%%s)' % join(', ', _file_cols))
+    for i in range(0, len(missing), MAX_VARS):
+        chunk = missing[i:i+MAX_VARS]
+        for row in _read(q % join(', ', ['?']*len(chunk)), chunk):
+            files[row[0]] = File(cols=row)
+    if _held != None:
+        _held.update(missing)
+    return files
+
+
+def _set_list(depsets):
+    '''
+    @param depsets The depsets column of a Files row
+    @return The ids of the shared sets it names
+    '''
+    return [int(id) for id in (depsets or '').split()]
+
+
+def _set_members(ids):
+    '''
+    @param ids The ids of shared sets
+    @return A map from set id to its members (see _sets)
+    '''
+    missing = list(set([id for id in ids if id not in _sets]))
+    q = 'select depset, mode, source from DepSetMembers where depset in (%s)'
+    for i in range(0, len(missing), MAX_VARS):
+        chunk = missing[i:i+MAX_VARS]
+        _set_put(_read(q % join(', ', ['?']*len(chunk)), chunk).fetchall())
+    return _sets
+
+
+def _set_put(members):
+    '''
+    Add sets to _sets
+    @param members DepSetMembers rows, as (set id, mode, source id)
+    '''
+    sets = {}
+    for (id, mode, source) in members:
+        sets.setdefault(id, []).append((mode, source))
+    for (id, l) in sets.items():
+        _sets[id] = tuple(sorted(l))
+
+
+def _intern(rows):
+    '''
+    Store a file's dependences as shared sets.  The sorted dependences
+    are cut where the mode changes, and after each source whose id
+    hashes to a multiple of SET_SPLIT; so where two files' lists differ
+    in a few sources, they still have most of their sets in common.
+    Each set is stored once, under a digest of its members.
+    @param rows The dependences, as (mode, source id)
+    @return The ids of the sets, for the depsets column of Files
+    '''
+    rows = sorted(set(rows))
+    ids = []
+    start = 0
+    for (i, (mode, source)) in enumerate(rows):
+        if (i + 1 == len(rows) or rows[i+1][0] != mode or
+            (source * 2654435761) % 2**32 < 2**32 // SET_SPLIT):
+            ids.append(_intern_set(tuple(rows[start:i+1])))
+            start = i + 1
+    return join(' ', [str(id) for id in ids])
+
+
+def _intern_set(members):
+    '''
+    @param members The members of a set, as sorted (mode, source id)
+    @return The id of the set, storing it if no file has it yet
+    '''
+    import hashlib
+    key = hashlib.sha1(join(' ', ['%s%d' % m for m in members])
+                       .encode('ascii')).hexdigest()
+    id = _set_ids.get(key)
+    if id != None:
+        return id
+    q = 'select id from DepSets where hash=?'
+    row = _read(q, [key]).fetchone()
+    if not row:
+        # some parallel redo may add it at the same time; no big deal.
+        _write('insert or ignore into DepSets (hash) values (?)', [key])
+        row = _read(q, [key]).fetchone()
+        for (mode, source) in members:
+            _write('insert or ignore into DepSetMembers '
+                   '    (depset, mode, source) values (?,?,?)',
+                   [row[0], mode, source])
+    id = row[0]
+    _set_ids[key] = id
+    _sets[id] = members
+    return id
+
+
+def _create_files(d):
+    # id is an alias for the rowid, which Deps refers to; declaring it keeps
+    # vacuum from renumbering the rows.
+    d.execute("create table Files "
+              "    (id integer primary key, "
+              "     name not null unique, "
+              "     is_generated int, "
+              "     is_override int, "
+              "     checked_runid int, "
+              "     changed_runid int, "
+              "     failed_runid int, "
+              "     mtime_ns int, "
+              "     size int, "
+              "     inode int, "
+              "     csum, "
+              "     digest, "
+              "     cutoff_runid int, "
+              "     duration_ms int, "
+              "     depsets default '')")
+
+
+def _create_dofiles(d):
+    # the .do files in each directory, as names separated by '/', and the
+    # directory's mtime when it was listed
+    d.execute("create table DoFiles "
+              "    (dir not null primary key, "
+              "     mtime_ns int, "
+              "     names not null)")
+
+
+def _create_depsets(d):
+    # each file's dependences are the members of the sets its depsets
+    # column names (see _intern); autoincrement keeps gc from letting a
+    # set's id be reused for different members
+    d.execute("create table DepSets "
+              "    (id integer primary key autoincrement, "
+              "     hash not null unique)")
+    d.execute("create table DepSetMembers "
+              "    (depset int, "
+              "     source int, "
+              "     mode not null, "
+              "     primary key (depset, source))")
+
+
+def _migrate(d):
+    '''
+    Upgrade the database schema in place, one version at a time
+    @param d The database connection
+    @return The resulting schema version
+    '''
+    d.execute("begin exclusive")
+    try:
+        # another redo may have migrated it while we were waiting
+        ver = d.execute("select version from Schema").fetchone()[0]
+        while ver in _migrations:
+            debug('state database: upgrading v%d to v%d\n' % (ver, ver+1))
+            _migrations[ver](d)
+            ver += 1
+            d.execute("update Schema set version=?", [ver])
+    except:
+        d.rollback()
+        raise
+    d.commit()
+    return ver
+
+
+def _stamp_from_v1(name, s):
+    '''
+    Convert a v1 stamp string to a stamp tuple.  The v1 stamp holds the
+    mtime as float seconds; if the file is unchanged, take the exact
+    nanosecond stamp from the file, so it doesn't look modified.
+    '''
+    if s == None:
+        return None
+    elif s == '0':
+        return STAMP_MISSING
+    elif s == 'dir':
+        return STAMP_DIR
+    try:
+        (mtime, size, ino) = [float(x.rstrip('L'))
+                              for x in s.strip('()').split(',')]
+    except ValueError:
+        return None
+    try:
+        st = os.stat(os.path.join(vars.BASE, name))
+    except OSError:
+        pass
+    else:
+        if str((st.st_mtime, st.st_size, st.st_ino)) == s:
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+    return (int(mtime * 1e9), int(size), int(ino))
+
+
+def _migrate_v1(d):
+    '''
+    v2: typed stamp columns instead of a stamp string, an integer
+    primary key for Files, and an index of dependencies by source
+    '''
+    d.execute("alter table Files rename to FilesV1")
+    _create_files(d)
+    q = ('select rowid, name, is_generated, is_override, checked_runid, '
+         '       changed_runid, failed_runid, stamp, csum '
+         '  from FilesV1')
+    rows = []
+    for row in d.execute(q).fetchall():
+        stamp = _stamp_from_v1(row[1], row[7]) or (None, None, None)
+        rows.append(list(row[:7]) + list(stamp) + [row[8]])
+    cols = _file_cols[:11]  # the v2 columns
+    d.executemany('insert into Files (%s) values (%s)'
+                  % (join(', ', cols), join(', ', ['?']*len(cols))),
+                  rows)
+    d.execute("drop table FilesV1")
+    d.execute("create index DepsSource on Deps (source)")
+
+
+def _migrate_v2(d):
+    '''
+    v3: a digest of the contents of each source file
+    '''
+    _add_column(d, 'Files', 'digest')
+
+
+def _migrate_v3(d):
+    '''
+    v4: the run in which each target last asked for early cutoff
+    '''
+    _add_column(d, 'Files', 'cutoff_runid', 'int')
+
+
+def _migrate_v4(d):
+    '''
+    v5: the listings of .do files in directories
+    '''
+    _create_dofiles(d)
+
+
+def _migrate_v5(d):
+    '''
+    v6: dependences stored as shared sets
+    '''
+    _add_column(d, 'Files', 'depsets', "default ''")
+    _create_depsets(d)
+    deps = {}
+    for (target, mode, source) in d.execute('select target, mode, source '
+                                            '  from Deps').fetchall():
+        deps.setdefault(target, []).append((mode, source))
+    for (target, rows) in deps.items():
+        _write('update Files set depsets=? where rowid=?',
+               [_intern(rows), target])
+    _flush()
+    d.execute('delete from Deps')
+
+
+def _migrate_v6(d):
+    '''
+    v7: how long each target's last successful build took
+    '''
+    _add_column(d, 'Files', 'duration_ms', 'int')
+
+
+def _add_column(d, table, col, type=''):
+    '''
+    Add a column to a table, unless an earlier migration already created
+    the table with it
+    '''
+    if col not in [row[1] for row in d.execute('pragma table_info(%s)' % table)]:
+        d.execute('alter table %s add column %s %s' % (table, col, type))
+
+
+# Functions that upgrade the schema from the version given by the key
+_migrations = {
+    1: _migrate_v1,
+    2: _migrate_v2,
+    3: _migrate_v3,
+    4: _migrate_v4,
+    5: _migrate_v5,
+    6: _migrate_v6,
+}
+
+
 def _write(q, l):
+    '''
+    Queue a write.  Queued writes are executed, in order, before the next
+    read or commit, so we hold the database write lock as briefly as
+    possible.
+    '''
     if _insane:
         return
-    global _wrote
-    _wrote += 1
-    db().execute(q, l)
+    _pending.append((q, l))
+
+
+def _flush():
+    '''
+    Execute the queued writes, batching runs of identical statements
+    '''
+    global _pending, _wrote
+    if not _pending:
+        return
+    pending = _pending
+    _pending = []
+    d = db()
+    i = 0
+    while i < len(pending):
+        q = pending[i][0]
+        j = i + 1
+        while j < len(pending) and pending[j][0] == q:
+            j += 1
+        if j - i == 1:
+            d.execute(q, pending[i][1])
+        else:
+            d.executemany(q, [l for (q2, l) in pending[i:j]])
+        _wrote += j - i
+        i = j
+
+
+def _read(q, l=[]):
+    '''
+    Execute a query after flushing the queued writes, so the query sees them
+    '''
+    _flush()
+    return db().execute(q, l)
 
 
@@ -4,7 +4,7 @@
 # ======================================================================
 
 import os
-from helpers import atoi
+from helpers import atoi, atof, parse_size
 
 # ----------------------------------------------------------------------
 # Initialization
@@ -30,6 +30,20 @@ VERBOSE = os.environ.get('REDO_VERBOSE', '') and 1 or 0
 XTRACE = os.environ.get('REDO_XTRACE', '') and 1 or 0
 KEEP_GOING = os.environ.get('REDO_KEEP_GOING', '') and 1 or 0
 SHUFFLE = os.environ.get('REDO_SHUFFLE', '') and 1 or 0
+CRITICAL_PATH = os.environ.get('REDO_CRITICAL_PATH', '') and 1 or 0
+FAILED_FIRST = os.environ.get('REDO_FAILED_FIRST', '') and 1 or 0
+WAL = os.environ.get('REDO_WAL', '') and 1 or 0
+COMMIT_WINDOW = atoi(os.environ.get('REDO_COMMIT_WINDOW', ''))
+STAT_CACHE = os.environ.get('REDO_STAT_CACHE', '') and 1 or 0
+CONTENT_STAMPS = os.environ.get('REDO_CONTENT_STAMPS', '') and 1 or 0
+EARLY_CUTOFF = os.environ.get('REDO_EARLY_CUTOFF', '') and 1 or 0
+CSUM_ALGO = os.environ.get('REDO_CSUM_ALGO', '') or 'sha1'
+GRAPH = os.environ.get('REDO_GRAPH', '') and 1 or 0
+STAT_THREADS = atoi(os.environ.get('REDO_STAT_THREADS', ''))
+FINGERPRINT = os.environ.get('REDO_FINGERPRINT', '') and 1 or 0
+ZYGOTE = os.environ.get('REDO_ZYGOTE', '') and 1 or 0
+LOAD_AVERAGE = atof(os.environ.get('REDO_LOAD_AVERAGE', ''))
+MAX_MEMORY = parse_size(os.environ.get('REDO_MAX_MEMORY', ''))
 STARTDIR = os.environ.get('REDO_STARTDIR', '')
 RUNID = atoi(os.environ.get('REDO_RUNID')) or None
 BASE = os.environ['REDO_BASE']
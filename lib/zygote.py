@@ -0,0 +1,374 @@
+# ======================================================================
+# zygote.py
+# Run redo commands in processes forked from a preloaded server
+# ======================================================================
+
+# The client side runs with python -S for every command a .do file runs,
+# so this imports as little as it can until it knows it is the server.
+# _socket is the C module under socket, which takes much longer to import.
+import sys, os, marshal, struct, _socket
+
+# ----------------------------------------------------------------------
+# Private constants
+# ----------------------------------------------------------------------
+
+# The modules the server imports, so the commands it forks needn't
+MODULES = ['vars_init', 'vars', 'log', 'helpers', 'options', 'state',
+           'statcache', 'graph', 'jobs', 'builder', 'deps', 'dofiles',
+           'fingerprint', 'targets_seen', 'traceback', 'hashlib',
+           'concurrent.futures', 'importlib.util']
+# The modules whose values come from the environment when they are
+# imported; a worker runs them again when its command imports them
+RELOAD = ['vars', 'log']
+# The most descriptors a client passes; with more, it runs the command
+# itself
+MAX_FDS = 200
+# The descriptor on which the server inherits its listening socket
+LISTEN_FD = 3
+# A length, a process id, or an exit status (exit code, or -signal)
+INT = struct.Struct('<i')
+
+# ----------------------------------------------------------------------
+# Private classes
+# ----------------------------------------------------------------------
+
+class _Reimporter(object):
+    '''
+    An import hook that, the first time a worker's command imports one of
+    the modules in RELOAD, runs it again in the module object that the
+    preloaded modules already refer to, so they see the command's values
+    '''
+    def __init__(self, modules):
+        '''
+        @param modules A map from name to module, for the modules to run
+        again; they must not be in sys.modules
+        '''
+        self.modules = modules
+        # importing replaces each module's spec with ours
+        self.loaders = dict([(name, module.__spec__.loader)
+                             for (name, module) in modules.items()])
+
+    def find_spec(self, name, path=None, target=None):
+        module = self.modules.get(name)
+        if module == None:
+            return None
+        import importlib.util
+        return importlib.util.spec_from_loader(name, self,
+                                               origin=module.__file__)
+
+    def create_module(self, spec):
+        return self.modules[spec.name]
+
+    def exec_module(self, module):
+        del self.modules[module.__name__]
+        self.loaders[module.__name__].exec_module(module)
+
+# ----------------------------------------------------------------------
+# Public functions
+# ----------------------------------------------------------------------
+
+def start():
+    '''
+    Start a zygote for the run, if vars.ZYGOTE is set and this is the
+    redo that starts the run.  Commands run by .do files find it through
+    REDO_ZYGOTE_SOCKET; it exits when this process does.
+    '''
+    import vars
+    if not vars.ZYGOTE or vars.TARGET or os.environ.get('REDO_ZYGOTE_SOCKET'):
+        return
+    import socket, tempfile, shutil, atexit, signal
+    from log import debug
+    # a directory only we can use, so nobody else can connect
+    dir = tempfile.mkdtemp(prefix='redo-')
+    path = os.path.join(dir, 'zygote')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+    except (OSError, socket.error) as e:
+        # e.g., the path is too long for a socket
+        debug('zygote: %s: %s\n' % (path, e))
+        shutil.rmtree(dir, ignore_errors=True)
+        return
+    sock.listen(128)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.dup2(sock.fileno(), LISTEN_FD)
+            os.closerange(LISTEN_FD + 1, _maxfd())
+            null = os.open(os.devnull, os.O_RDWR)
+            os.dup2(null, 0)
+            os.dup2(null, 1)
+            os.execv(sys.executable, [sys.executable,
+                                      os.path.abspath(__file__), '--serve'])
+        finally:
+            os._exit(127)
+    sock.close()
+    os.environ['REDO_ZYGOTE_SOCKET'] = path
+    debug('zygote: pid %d on %s\n' % (pid, path))
+
+    def stop():
+        try:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+        shutil.rmtree(dir, ignore_errors=True)
+    atexit.register(stop)
+
+# ----------------------------------------------------------------------
+# Private functions
+# ----------------------------------------------------------------------
+
+def _maxfd():
+    try:
+        return os.sysconf('SC_OPEN_MAX')
+    except (ValueError, OSError):
+        return 1024
+
+
+def _fds():
+    '''
+    @return The open descriptors of this process
+    '''
+    try:
+        names = os.listdir('/dev/fd')
+    except OSError:
+        names = [str(fd) for fd in range(256)]
+    fds = []
+    for name in names:
+        try:
+            fd = int(name)
+            os.fstat(fd)  # the one listdir used is closed by now
+        except (ValueError, OSError):
+            continue
+        fds.append(fd)
+    return sorted(fds)
+
+
+def _client(script, args):
+    '''
+    Run a command in a worker forked from the zygote, with this
+    process's arguments, environment, directory and descriptors, and
+    exit as it does; or, if there is no zygote to connect to, run it
+    here.
+    @param script The path of the command's .py file
+    @param args Its arguments
+    '''
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    fds = [fd for fd in _fds() if fd != sock.fileno()]
+    try:
+        if len(fds) > MAX_FDS:
+            raise OSError('too many descriptors')
+        sock.connect(os.environ['REDO_ZYGOTE_SOCKET'])
+    except (OSError, KeyError):
+        sock.close()
+        os.execv(sys.executable, [sys.executable, script] + args)
+    data = marshal.dumps((script, args, dict(os.environ), os.getcwd(),
+                          fds, os.getpgrp()))
+    data = INT.pack(len(data)) + data
+    # the descriptors go with the first byte
+    n = sock.sendmsg([data], [(_socket.SOL_SOCKET, _socket.SCM_RIGHTS,
+                               struct.pack('%di' % len(fds), *fds))])
+    sock.sendall(data[n:])
+    pid = _recv_int(sock)
+    import _signal
+    def forward(sig, frame):
+        os.kill(pid, sig)
+    # the worker is in our process group, so it gets the terminal's
+    # signals itself; others we pass on
+    for sig in (_signal.SIGTERM, _signal.SIGHUP):
+        _signal.signal(sig, forward)
+    _signal.signal(_signal.SIGINT, _signal.SIG_IGN)
+    status = _recv_int(sock)
+    if status < 0:
+        _signal.signal(-status, _signal.SIG_DFL)
+        os.kill(os.getpid(), -status)
+        status = 128 - status
+    sys.exit(status)
+
+
+def _recv_int(sock):
+    data = b''
+    while len(data) < INT.size:
+        b = sock.recv(INT.size - len(data))
+        if not b:
+            sys.stderr.write('redo: zygote: connection lost\n')
+            sys.exit(1)
+        data += b
+    return INT.unpack(data)[0]
+
+
+def _serve():
+    '''
+    Import the modules, then accept connections on LISTEN_FD, forking a
+    worker for each, until the redo that started us exits.  The server
+    sends each client its worker's pid, then its exit status.
+    @return In a worker, the connection to its client and a map from
+    each command's path to its compiled code; the server never returns
+    '''
+    import socket, select, signal
+    for m in MODULES:
+        __import__(m)
+    # keep the collector out of the modules' pages, so workers share them
+    import gc
+    gc.freeze()
+    # the commands' code, compiled once here instead of in every worker
+    codes = {}
+    dir = os.path.dirname(os.path.abspath(__file__))
+    for name in os.listdir(dir):
+        if name.startswith('redo') and name.endswith('.py'):
+            path = os.path.join(dir, name)
+            with open(path) as f:
+                codes[path] = compile(f.read(), path, 'exec')
+    listener = socket.socket(fileno=LISTEN_FD)
+    parent = os.getppid()
+    (r, w) = os.pipe()
+    os.set_blocking(w, False)
+    signal.set_wakeup_fd(w)
+    signal.signal(signal.SIGCHLD, lambda sig, frame: None)
+    # ^C is for the commands, which are in the terminal's process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    workers = {}
+    while os.getppid() == parent:
+        try:
+            (ready, x, y) = select.select([listener, r], [], [], 1.0)
+        except (OSError, select.error):
+            continue  # interrupted
+        if r in ready:
+            os.read(r, 4096)
+        while workers:
+            (pid, status) = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            conn = workers.pop(pid, None)
+            if not conn:
+                continue
+            if os.WIFSIGNALED(status):
+                status = -os.WTERMSIG(status)
+            else:
+                status = os.WEXITSTATUS(status)
+            try:
+                conn.sendall(INT.pack(status))
+            except (OSError, socket.error):
+                pass
+            conn.close()
+        if listener in ready:
+            try:
+                (conn, addr) = listener.accept()
+            except (OSError, socket.error):
+                continue
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                signal.set_wakeup_fd(-1)
+                listener.close()
+                os.close(r)
+                os.close(w)
+                for c in workers.values():
+                    c.close()
+                return (conn, codes)
+            workers[pid] = conn
+            try:
+                conn.sendall(INT.pack(pid))
+            except (OSError, socket.error):
+                pass
+    sys.exit(0)
+
+
+def _work(conn, codes):
+    '''
+    Become the client's process and run its command
+    @param conn The connection to the client
+    @param codes A map from script path to compiled code
+    '''
+    import socket, fcntl, signal
+    (msg, ancdata, flags, addr) = conn.recvmsg(
+        65536, socket.CMSG_SPACE(MAX_FDS * INT.size))
+    received = []
+    for (level, type, data) in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            n = len(data) // INT.size
+            received += list(struct.unpack('%di' % n, data[:n * INT.size]))
+    (length,) = INT.unpack(msg[:INT.size])
+    msg = msg[INT.size:]
+    while len(msg) < length:
+        b = conn.recv(length - len(msg))
+        if not b:
+            os._exit(1)
+        msg += b
+    (script, args, env, cwd, fds, pgid) = marshal.loads(msg)
+    conn.close()
+
+    # put the client's descriptors where it had them, and close the rest
+    top = max(fds + received + [2]) + 1
+    moved = [fcntl.fcntl(fd, fcntl.F_DUPFD, top) for fd in received]
+    for fd in _fds():
+        if fd not in moved:
+            os.close(fd)
+    for (fd, tmp) in zip(fds, moved):
+        os.dup2(tmp, fd)
+        os.close(tmp)
+    sys.stdin = open(0, 'r', closefd=False)
+    sys.stdout = open(1, 'w', closefd=False)
+    sys.stderr = open(2, 'w', closefd=False, buffering=1)
+
+    os.environ.clear()
+    os.environ.update(env)
+    os.chdir(cwd)
+    try:
+        os.setpgid(0, pgid)
+    except OSError:
+        pass
+    sys.argv = [script] + args
+    sys.meta_path.insert(0, _Reimporter(dict([(m, sys.modules.pop(m))
+                                              for m in RELOAD])))
+    if 'random' in sys.modules:
+        sys.modules['random'].seed()  # or every worker shuffles alike
+    code = codes.get(script)
+    if code == None:
+        with open(script) as f:
+            code = compile(f.read(), script, 'exec')
+    try:
+        exec(code, {'__name__': '__main__', '__file__': script})
+        status = 0
+    except SystemExit as e:
+        status = _exit_code(e.code)
+    except KeyboardInterrupt:
+        status = -signal.SIGINT
+    except BaseException:
+        sys.excepthook(*sys.exc_info())
+        status = 1
+    # tearing down all the preloaded modules takes longer than the command
+    # did, so do only what exiting does that the client can notice
+    import atexit
+    atexit._run_exitfuncs()
+    for f in (sys.stdout, sys.stderr):
+        try:
+            f.flush()
+        except (OSError, ValueError):
+            pass
+    if status < 0:
+        signal.signal(-status, signal.SIG_DFL)
+        os.kill(os.getpid(), -status)
+        status = 128 - status
+    os._exit(status)
+
+
+def _exit_code(code):
+    '''
+    @return The exit code for sys.exit(code)
+    '''
+    if code == None:
+        return 0
+    if isinstance(code, int):
+        return code & 0xff
+    sys.stderr.write('%s\n' % code)
+    return 1
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--serve']:
+        _work(*_serve())
+    else:
+        _client(sys.argv[1], sys.argv[2:])
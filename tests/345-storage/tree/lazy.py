@@ -0,0 +1,18 @@
+# lazy.py libdir: check that a lazy commit, which --commit-window lets
+# us skip, still notices that another process has changed the rows we
+# have cached
+import sys, os, sqlite3
+sys.path.insert(0, sys.argv[1])
+import vars, state
+
+assert vars.COMMIT_WINDOW
+state.commit()
+before = state.File(name='dep').csum
+db = sqlite3.connect(os.path.join(vars.BASE, '.redo/db.sqlite3'))
+db.execute("update Files set csum='other' where name='dep'")
+db.commit()
+state.commit(lazy=True)
+after = state.File(name='dep').csum
+if before != None or after != 'other':
+    sys.stderr.write('dep csum: %r, then %r\n' % (before, after))
+    sys.exit(1)
@@ -0,0 +1,21 @@
+# cache.py libdir get path mtime size ino: print the stamp of path from
+#   the stat cache, or share the stamp given if it has none
+# cache.py libdir forget path: forget the stamp of path
+# cache.py libdir race path: get the stamp of path, while another process
+#   forgets it between our stat and our sharing what we read
+import sys, os, subprocess
+sys.path.insert(0, sys.argv[1])
+import statcache
+
+(cmd, path) = sys.argv[2:4]
+if cmd == 'get':
+    stamp = tuple([int(x) for x in sys.argv[4:7]])
+    print('%d %d %d' % statcache.get(path, lambda p: stamp))
+elif cmd == 'forget':
+    statcache.forget(path)
+elif cmd == 'race':
+    def stat(p):
+        subprocess.check_call([sys.executable, __file__, sys.argv[1],
+                               'forget', p])
+        return (1, 2, 3)
+    print('%d %d %d' % statcache.get(path, stat))
@@ -0,0 +1,20 @@
+# fresh.py libdir: check that a target's dependences are read as they are
+# now, even when another process has changed them since we last read them
+import sys, os, sqlite3
+sys.path.insert(0, sys.argv[1])
+import vars, state
+
+
+def dep_csum():
+    t = state.File(name='t')
+    return [f.csum for (key, deps) in t.dep_sets() for (mode, f) in deps
+            if f.name == 'dep']
+
+before = dep_csum()
+db = sqlite3.connect(os.path.join(vars.BASE, '.redo/db.sqlite3'))
+db.execute("update Files set csum='other' where name='dep'")
+db.commit()
+after = dep_csum()
+if before != [None] or after != ['other']:
+    sys.stderr.write('dep csum: %r, then %r\n' % (before, after))
+    sys.exit(1)
@@ -0,0 +1,23 @@
+# measure name command...
+#
+# Run a command once with python's import timing, into name.imp, and if
+# $BENCH_N is set, run it that many times more and append its average
+# time per call, in microseconds, to times.  Every command reads src,
+# which redo-stamp checksums and the others ignore.
+measure() {
+	name=$1
+	shift
+	PYTHONPROFILEIMPORTTIME=1 "$@" <src >/dev/null 2>$name.imp || true
+	[ -n "$BENCH_N" ] || return 0
+	start=$(usecs)
+	i=0
+	while [ $i -lt $BENCH_N ]; do
+		"$@" <src >/dev/null 2>&1 || true
+		i=$((i + 1))
+	done
+	echo "$name $(( ($(usecs) - start) / BENCH_N ))" >>times
+}
+
+usecs() {
+	python -c 'import time; print(int(time.time() * 1e6))'
+}
@@ -0,0 +1,22 @@
+# Measure each redo command in a tree of our own, with its own .redo, so
+# redo-gc and redo-remove can run too.  The commands that .do scripts
+# run are measured in cmds.do; the rest as a user runs them.
+. ../skip-if-minimal-do.sh
+dir=$(mktemp -d)
+trap 'rm -rf "$dir"' EXIT
+cp tree/*.do measure.sh "$dir"
+touch "$dir/.redo-base"
+echo 1 >"$dir/src"
+cd "$dir"
+env -i PATH="$PATH" HOME="$HOME" BENCH_N="$BENCH_N" sh -ec '
+	redo cmds >&2
+	. ./measure.sh
+	measure redo redo leaf
+	measure redo-base redo-base
+	measure redo-sources redo-sources
+	measure redo-targets redo-targets
+	measure redo-ood redo-ood
+	measure redo-remove redo-remove leaf
+	measure redo-gc redo-gc
+'
+cd - >/dev/null
@@ -0,0 +1,11 @@
+# wait.sh name: wait until four jobs have started, so they can only all
+# finish if four tokens are shared among the processes that run them
+touch started/$1
+n=0
+while :; do
+	set -- started/*
+	[ $# -ge 4 ] && break
+	[ $n -lt 300 ] || exit 1  # a minute
+	sleep 0.2
+	n=$((n + 1))
+done
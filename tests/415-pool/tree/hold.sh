@@ -0,0 +1,12 @@
+# hold.sh: the first time, hold the pool's slot until another redo-pool
+# is asleep waiting for it, which /proc/locks shows as a blocked lock on
+# the pool's file
+[ ! -e held ] || exit 0
+touch held
+ino=$(ls -i .redo/pool.one | cut -d' ' -f1)
+n=0
+until grep -Eq "^[0-9]+: -> .*:$ino " /proc/locks; do
+	[ $n -lt 100 ] || exit 1  # ten seconds
+	sleep 0.1
+	n=$((n + 1))
+done
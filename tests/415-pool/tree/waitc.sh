@@ -0,0 +1,8 @@
+# wait until c.n has started, which it can only do with our token if
+# there is just one to go round
+n=0
+while [ ! -e started/c ]; do
+	[ $n -lt 150 ] || exit 1  # half a minute
+	sleep 0.2
+	n=$((n + 1))
+done